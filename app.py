@@ -1,15 +1,353 @@
 import streamlit as st
-import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import pyarrow as pa
 import io
 import os
-from src.processador_orcamento import ProcessadorOrcamento
-from src.gerador_lote import GeradorLote
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import date
 
 ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
 REGRA41_PATH = os.path.join(ASSETS_DIR, 'Itens da Regra de Mapeamento 41 (2).xls')
 REGRA100_PATH = os.path.join(ASSETS_DIR, 'Itens da Regra de Mapeamento 100 (1).xls')
 
+# Remove pontos e espaços dos códigos de natureza digitados (ex: "3.3.90.18" → "339018")
+TABELA_LIMPEZA_CODIGO = str.maketrans('', '', '. \t\r')
+
+# Tamanho máximo do log de diagnósticos exibido na página (em caracteres)
+LIMITE_LOG_EXIBIDO = 200_000
+
+# Intervalo (em segundos) entre as verificações do processamento em segundo plano
+INTERVALO_CONSULTA_PROCESSAMENTO = 1.0
+
+# st.fragment (Streamlit >= 1.37, experimental_fragment desde 1.33) reexecuta apenas a seção
+# de resultados quando seus próprios widgets mudam. Nas versões anteriores, não tem efeito
+fragmento = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda func: func)
+
+
+# max_entries: limita quantos resultados (com a planilha gerada) ficam retidos em memória
+@st.cache_data(show_spinner=False, max_entries=4)
+def processar_planilha(conteudo: bytes, nome_arquivo: str, fonte_proibida, naturezas_proibidas: frozenset,
+                       log_detalhado: bool = False):
+    # Cache por conteúdo do arquivo + configurações: reprocessar a mesma entrada não lê o Excel de novo
+    # Import tardio: pandas/openpyxl/numpy só são carregados quando há processamento
+    from src.processador_orcamento import ProcessadorOrcamento
+
+    arquivo = io.BytesIO(conteudo)
+    arquivo.name = nome_arquivo  # ler_planilha usa a extensão para escolher o engine
+
+    processador = ProcessadorOrcamento(
+        fonte_proibida=fonte_proibida,
+        naturezas_proibidas=naturezas_proibidas,
+        log_detalhado=log_detalhado
+    )
+    return processador.processar_arquivo(arquivo)
+
+
+@st.cache_resource
+def executor_processamento():
+    # Pool compartilhado entre sessões: o processamento não ocupa a thread do script
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def executar_com_contexto(contexto, funcao, *argumentos):
+    # Roda no pool: anexa o ScriptRunContext da sessão que submeteu a tarefa (o st.cache_data
+    # precisa dele); as threads são reaproveitadas, então o contexto é trocado a cada tarefa
+    add_script_run_ctx(threading.current_thread(), contexto)
+    return funcao(*argumentos)
+
+
+def iniciar_processamento(argumentos):
+    # Tabelas em sessão pertencem ao processamento anterior
+    descartar_tabelas()
+
+    # Processar arquivo em segundo plano (resultado em cache para entradas idênticas)
+    st.session_state['processamento'] = executor_processamento().submit(
+        executar_com_contexto, get_script_run_ctx(), processar_planilha, *argumentos
+    )
+
+
+def interpretar_configuracao(fonte_proibida_input: str, naturezas_input: str) -> dict:
+    # Resultado guardado em sessão com o texto bruto como chave: reruns sem edição não reinterpretam
+    chave = (fonte_proibida_input, naturezas_input)
+    configuracao = st.session_state.get('configuracao_interpretada')
+    if configuracao is not None and configuracao['chave'] == chave:
+        return configuracao
+
+    fonte_texto = fonte_proibida_input.strip()
+    fonte_proibida = int(fonte_texto) if fonte_texto.isdecimal() else None
+
+    # Processar naturezas (frozenset: imutável e utilizável como chave de cache)
+    naturezas_proibidas = frozenset(
+        linha.translate(TABELA_LIMPEZA_CODIGO)
+        for linha in naturezas_input.split('\n')
+        if linha.strip()
+    )
+    codigos_invalidos = sorted(c for c in naturezas_proibidas if not c.isdigit())
+
+    configuracao = {
+        'chave': chave,
+        'fonte_proibida': fonte_proibida,
+        'fonte_invalida': bool(fonte_texto) and fonte_proibida is None,
+        'naturezas_proibidas': naturezas_proibidas.difference(codigos_invalidos),
+        'codigos_invalidos': codigos_invalidos
+    }
+    st.session_state['configuracao_interpretada'] = configuracao
+    return configuracao
+
+
+def montar_tabela(linhas):
+    # Tabela para exibição construída pelo Arrow: a inferência de tipos roda em C++ e o
+    # st.dataframe serializa as colunas ArrowDtype sem nova conversão pandas → Arrow
+    import pandas as pd
+
+    if linhas is None:
+        return pd.DataFrame()
+
+    # Remanejamentos chegam como colunas (dict de listas): vazio quando as colunas não têm linhas
+    if isinstance(linhas, dict):
+        if not linhas or not len(next(iter(linhas.values()))):
+            return pd.DataFrame()
+        return pa.Table.from_pydict(linhas).to_pandas(types_mapper=pd.ArrowDtype)
+
+    # Déficits chegam como lista de linhas
+    if not len(linhas):
+        return pd.DataFrame()
+    return pa.Table.from_pylist(linhas).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def tabela_em_sessao(chave, linhas):
+    # Reaproveita a tabela já montada nos reruns seguintes (descartada a cada novo processamento)
+    if chave not in st.session_state:
+        st.session_state[chave] = montar_tabela(linhas)
+    return st.session_state[chave]
+
+
+def descartar_tabelas():
+    for chave in ('df_deficits', 'df_remanejamentos'):
+        st.session_state.pop(chave, None)
+
+
+def descartar_arquivo_excel():
+    # Após o download, libera os bytes da planilha da sessão. Um novo clique em
+    # "Calcular Remanejamento" recupera o arquivo do cache de processar_planilha
+    resultado = st.session_state.get('resultado')
+    if resultado is not None:
+        resultado.pop('arquivo_excel', None)
+
+
+@fragmento
+def exibir_resultados(resultado, nome_arquivo):
+    import pandas as pd
+
+    st.header("4. Análise dos Resultados")
+
+    # Métricas resumidas
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        st.metric(
+            "UGs Analisadas",
+            resultado['estatisticas']['total_ugs']
+        )
+
+    with col2:
+        st.metric(
+            "Déficits Encontrados",
+            resultado['estatisticas']['total_deficits']
+        )
+
+    with col3:
+        st.metric(
+            "Remanejamentos Internos",
+            resultado['estatisticas']['remanejamentos_internos']
+        )
+
+    with col4:
+        st.metric(
+            "Remanejamentos Externos",
+            resultado['estatisticas']['remanejamentos_externos']
+        )
+
+    # Exibir déficits encontrados
+    # len(): funciona também se vier como array/DataFrame (truthiness seria ambígua)
+    if resultado.get('deficits') is not None and len(resultado['deficits']):
+        with st.expander("📊 Déficits Identificados", expanded=True):
+            df_deficits = tabela_em_sessao('df_deficits', resultado['deficits'])
+            st.dataframe(
+                df_deficits,
+                use_container_width=True,
+                hide_index=True
+            )
+
+    # Exibir remanejamentos
+    if resultado.get('remanejamentos') is not None and len(resultado['remanejamentos']['Valor']):
+        with st.expander("🔄 Remanejamentos Realizados", expanded=False):
+            df_remanejamentos = tabela_em_sessao('df_remanejamentos', resultado['remanejamentos'])
+            st.dataframe(
+                df_remanejamentos,
+                use_container_width=True,
+                hide_index=True
+            )
+
+    # Exibir diagnósticos detalhados
+    with st.expander("🔍 Diagnósticos Detalhados (Log de Processamento)", expanded=False):
+        diagnosticos = resultado.get('diagnosticos', 'Nenhum diagnóstico disponível')
+
+        # Logs grandes: exibe apenas o final e oferece o log completo para download
+        if len(diagnosticos) > LIMITE_LOG_EXIBIDO:
+            st.caption(f"Exibindo os últimos {LIMITE_LOG_EXIBIDO:,} caracteres do log.".replace(',', '.'))
+            st.download_button(
+                label="📥 Baixar Log Completo",
+                data=diagnosticos,
+                file_name=f"log_processamento_{os.path.splitext(nome_arquivo)[0]}.txt",
+                mime="text/plain"
+            )
+            diagnosticos = diagnosticos[-LIMITE_LOG_EXIBIDO:]
+
+        st.text(diagnosticos)
+
+    # Validações
+    st.header("5. Validações")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        if resultado['validacoes']['nenhum_saldo_negativo']:
+            st.success("✅ Nenhuma UG ficou com saldo negativo")
+        else:
+            st.error("❌ Ainda existem saldos negativos!")
+
+    with col2:
+        if resultado['validacoes']['somas_conferem']:
+            st.success("✅ Somas das transferências conferem")
+        else:
+            st.warning("⚠️ Inconsistência nas somas")
+
+    # Download do arquivo
+    st.header("6. Download do Arquivo Ajustado")
+
+    if 'arquivo_excel' in resultado:
+        st.download_button(
+            label="📥 Baixar Planilha Ajustada",
+            data=resultado['arquivo_excel'],
+            file_name=f"orcamento_ajustado_{nome_arquivo}",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            type="primary",
+            use_container_width=True,
+            on_click=descartar_arquivo_excel
+        )
+    else:
+        st.info("📥 Planilha já baixada. Clique em \"Calcular Remanejamento\" para baixá-la novamente.")
+
+    st.info("""
+    📋 **O arquivo contém duas abas:**
+    - **Aba 1**: Saldos Ajustados (mesma estrutura da planilha original, com valores corrigidos)
+    - **Aba 2**: Quadro de Remanejamento (detalhamento de todas as transferências realizadas)
+    """)
+
+    # Gerador
+    st.header("7. Gerar Arquivo SIAFE")
+
+    st.markdown("""
+    Gere o arquivo no formato de importação em lote do SIAFE a partir dos
+    remanejamentos calculados. Você precisa fornecer os arquivos de Regras
+    de Mapeamento e preencher os dados obrigatórios.
+    """)
+
+    with st.expander("📤 Configurar e Gerar Arquivo SIAFE", expanded=False):
+        st.subheader("Dados Obrigatórios")
+
+        col_d1, col_d2 = st.columns(2)
+        with col_d1:
+            data_emissao = st.date_input(
+                "Data de Emissão",
+                value=date.today(),
+                format="DD/MM/YYYY"
+            )
+        with col_d2:
+            processo = st.text_input(
+                "Número do Processo",
+                value="",
+                placeholder="Ex: 2026/00001",
+                help="Número do processo administrativo"
+            )
+
+        observacao = st.text_input(
+            "Observação",
+            value="REMANEJAMENTO FOLHA DE PESSOAL",
+            help="Texto descritivo para o campo Observação do SIAFE"
+        )
+
+        st.caption("ℹ️ A UG Emitente é preenchida automaticamente com a UG Acrescida (UG Destino) de cada linha.")
+
+        # Botão para gerar
+        gerar_siafe = st.button(
+            "📄 Gerar Arquivo SIAFE",
+            type="secondary",
+            use_container_width=True,
+        )
+
+        if gerar_siafe:
+            with st.spinner("Gerando arquivo SIAFE..."):
+                try:
+                    from src.gerador_lote import GeradorLote
+
+                    gerador = GeradorLote()
+
+                    # Carregar Regra 41 do diretório assets/
+                    gerador.carregar_regra41(REGRA41_PATH)
+                    st.info(f"📋 Regra 41 carregada: {len(gerador.mapa_ug)} UGs mapeadas")
+
+                    # Carregar Regra 100 do diretório assets/
+                    gerador.carregar_regra100(REGRA100_PATH)
+                    st.info("📋 Regra 100 carregada")
+
+                    # Preparar DataFrame de remanejamentos
+                    df_rem = pd.DataFrame(resultado['remanejamentos'])
+
+                    # Formatar data
+                    data_fmt = data_emissao.strftime("%d/%m/%Y")
+
+                    # Gerar lote
+                    arquivo_siafe, erros = gerador.gerar_lote(
+                        df_remanejamentos=df_rem,
+                        data_emissao=data_fmt,
+                        observacao=observacao,
+                        processo=processo,
+                    )
+
+                    # Exibir erros (se houver)
+                    if erros:
+                        st.markdown(f"**⚠️ {len(erros)} aviso(s) durante a geração:**")
+                        for erro in erros:
+                            st.warning(erro)
+
+                    # Contar linhas
+                    n_remanejamentos = len(df_rem)
+                    n_linhas_siafe = n_remanejamentos * 2
+
+                    st.success(
+                        f"✅ Arquivo SIAFE gerado com sucesso! "
+                        f"{n_remanejamentos} remanejamentos → {n_linhas_siafe} linhas SIAFE "
+                        f"(Redução + Acréscimo para cada)"
+                    )
+
+                    # Download
+                    st.download_button(
+                        label="📥 Baixar Arquivo SIAFE",
+                        data=arquivo_siafe,
+                        file_name=f"siafe_importacao_{data_emissao.strftime('%Y%m%d')}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        type="primary",
+                        use_container_width=True
+                    )
+
+                except Exception as e:
+                    st.error(f"❌ Erro ao gerar arquivo SIAFE: {str(e)}")
+                    st.exception(e)
+
 
 def main():
     st.set_page_config(
@@ -34,9 +372,16 @@ def main():
     if uploaded_file is not None:
         st.success(f"✅ Arquivo carregado: {uploaded_file.name}")
 
+        # Conteúdo lido uma única vez por upload e reaproveitado em cada processamento
+        if st.session_state.get('arquivo_id') != uploaded_file.file_id:
+            st.session_state['arquivo_id'] = uploaded_file.file_id
+            st.session_state['arquivo_bytes'] = uploaded_file.getvalue()
+            descartar_tabelas()
+
         st.header("2. Configurações")
 
-        with st.expander("⚙️ Configurar Fonte e Naturezas Proibidas", expanded=True):
+        # Formulário: edições nos campos não disparam rerun até o envio
+        with st.form("configuracao", clear_on_submit=False):
             col1, col2 = st.columns(2)
 
             with col1:
@@ -48,13 +393,6 @@ def main():
                     placeholder="Ex: 761"
                 )
 
-                fonte_proibida = None
-                if fonte_proibida_input.strip():
-                    try:
-                        fonte_proibida = int(fonte_proibida_input.strip())
-                    except ValueError:
-                        st.error("Fonte deve ser um número inteiro!")
-
             with col2:
                 st.subheader("Naturezas Proibidas")
                 naturezas_input = st.text_area(
@@ -65,241 +403,100 @@ def main():
                     placeholder="339018\n339092\n..."
                 )
 
-                # Processar naturezas
-                naturezas_proibidas = set()
-                if naturezas_input.strip():
-                    for linha in naturezas_input.strip().split('\n'):
-                        codigo = linha.strip()
-                        if codigo:
-                            # Remover pontos e espaços
-                            codigo_limpo = codigo.replace('.', '').replace(' ', '')
-                            naturezas_proibidas.add(codigo_limpo)
-
-                if naturezas_proibidas:
-                    st.info(f"📋 {len(naturezas_proibidas)} natureza(s) configurada(s) como proibida(s)")
-
-        # Botão para processar
-        st.header("3. Processamento")
-
-        col1, col2 = st.columns([1, 3])
-        with col1:
-            processar = st.button("🔄 Calcular Remanejamento", type="primary", use_container_width=True)
-
-        if processar:
-            with st.spinner("Processando planilha... Por favor aguarde."):
-                try:
-                    # Inicializar processador com as configurações
-                    processador = ProcessadorOrcamento(
-                        fonte_proibida=fonte_proibida,
-                        naturezas_proibidas=naturezas_proibidas
-                    )
-
-                    # Processar arquivo
-                    resultado = processador.processar_arquivo(uploaded_file)
-
-                    # Armazenar no session_state
-                    st.session_state['resultado'] = resultado
-                    st.session_state['processado'] = True
-
-                    st.success("✅ Processamento concluído com sucesso!")
-
-                except Exception as e:
-                    st.error(f"❌ Erro ao processar arquivo: {str(e)}")
-                    st.exception(e)
-                    return
-
-        # Exibir resultados se já processado
-        if st.session_state.get('processado', False):
-            resultado = st.session_state['resultado']
-
-            st.header("4. Análise dos Resultados")
-
-            # Métricas resumidas
-            col1, col2, col3, col4 = st.columns(4)
+            # Interpretação dos campos (reaproveitada enquanto o texto não mudar)
+            configuracao = interpretar_configuracao(fonte_proibida_input, naturezas_input)
+            fonte_proibida = configuracao['fonte_proibida']
+            naturezas_proibidas = configuracao['naturezas_proibidas']
 
             with col1:
-                st.metric(
-                    "UGs Analisadas",
-                    resultado['estatisticas']['total_ugs']
-                )
+                if configuracao['fonte_invalida']:
+                    st.error("Fonte deve ser um número inteiro!")
 
             with col2:
-                st.metric(
-                    "Déficits Encontrados",
-                    resultado['estatisticas']['total_deficits']
-                )
+                if configuracao['codigos_invalidos']:
+                    st.error(f"Naturezas devem conter apenas números! Inválidas: {', '.join(configuracao['codigos_invalidos'])}")
 
-            with col3:
-                st.metric(
-                    "Remanejamentos Internos",
-                    resultado['estatisticas']['remanejamentos_internos']
-                )
-
-            with col4:
-                st.metric(
-                    "Remanejamentos Externos",
-                    resultado['estatisticas']['remanejamentos_externos']
-                )
-
-            # Exibir déficits encontrados
-            if resultado['deficits']:
-                with st.expander("📊 Déficits Identificados", expanded=True):
-                    df_deficits = pd.DataFrame(resultado['deficits'])
-                    st.dataframe(
-                        df_deficits,
-                        use_container_width=True,
-                        hide_index=True
-                    )
-
-            # Exibir remanejamentos
-            if resultado['remanejamentos']:
-                with st.expander("🔄 Remanejamentos Realizados", expanded=False):
-                    df_remanejamentos = pd.DataFrame(resultado['remanejamentos'])
-                    st.dataframe(
-                        df_remanejamentos,
-                        use_container_width=True,
-                        hide_index=True
-                    )
-
-            # Exibir diagnósticos detalhados
-            with st.expander("🔍 Diagnósticos Detalhados (Log de Processamento)", expanded=False):
-                st.code(resultado.get('diagnosticos', 'Nenhum diagnóstico disponível'), language='text')
-
-            # Validações
-            st.header("5. Validações")
+                if naturezas_proibidas:
+                    st.info(f"📋 {len(naturezas_proibidas)} natureza(s) configurada(s) como proibida(s)")
 
-            col1, col2 = st.columns(2)
+            log_detalhado = st.checkbox(
+                "Log detalhado de diagnóstico",
+                value=False,
+                help="Registra cada natureza e cada transferência no log de diagnóstico. "
+                     "Deixa o processamento mais lento em planilhas grandes."
+            )
 
+            col1, col2 = st.columns([1, 3])
             with col1:
-                if resultado['validacoes']['nenhum_saldo_negativo']:
-                    st.success("✅ Nenhuma UG ficou com saldo negativo")
-                else:
-                    st.error("❌ Ainda existem saldos negativos!")
-
-            with col2:
-                if resultado['validacoes']['somas_conferem']:
-                    st.success("✅ Somas das transferências conferem")
-                else:
-                    st.warning("⚠️ Inconsistência nas somas")
+                processar = st.form_submit_button("🔄 Calcular Remanejamento", type="primary", use_container_width=True)
 
-            # Download do arquivo
-            st.header("6. Download do Arquivo Ajustado")
+        st.header("3. Processamento")
 
-            st.download_button(
-                label="📥 Baixar Planilha Ajustada",
-                data=resultado['arquivo_excel'],
-                file_name=f"orcamento_ajustado_{uploaded_file.name}",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                type="primary",
-                use_container_width=True
+        if processar:
+            argumentos = (
+                st.session_state['arquivo_bytes'],
+                uploaded_file.name,
+                fonte_proibida,
+                naturezas_proibidas,
+                log_detalhado
             )
+            if 'processamento' in st.session_state:
+                # Já há um processamento em andamento: as configurações novas ficam na fila
+                # (só a mais recente) e são processadas assim que ele terminar
+                st.session_state['processamento_pendente'] = argumentos
+            else:
+                iniciar_processamento(argumentos)
+
+        processamento = st.session_state.get('processamento')
+        if processamento is not None:
+            if 'processamento_pendente' in st.session_state:
+                st.info("⏳ Já existe um processamento em andamento. As novas configurações serão processadas assim que ele terminar.")
+
+            if not processamento.done():
+                # Aguarda dentro desta execução do script: no Streamlit 1.31 cada st.rerun() empilha
+                # uma nova chamada de _run_script, e um rerun por consulta estouraria a pilha
+                # em processamentos longos. A atualização do tempo decorrido a cada consulta
+                # permite que um novo clique interrompa a espera (e entre na fila acima)
+                inicio = time.monotonic()
+                tempo_decorrido = st.empty()
+                with st.spinner("Processando planilha... Por favor aguarde."):
+                    while not wait([processamento], timeout=INTERVALO_CONSULTA_PROCESSAMENTO).done:
+                        tempo_decorrido.caption(f"Tempo decorrido: {time.monotonic() - inicio:.0f} s")
+                tempo_decorrido.empty()
+
+            del st.session_state['processamento']
+
+            # Resultado de configurações já substituídas: processa as pendentes em vez de exibi-lo
+            pendente = st.session_state.pop('processamento_pendente', None)
+            if pendente is not None:
+                iniciar_processamento(pendente)
+                st.rerun()
+
+            try:
+                resultado = processamento.result()
+
+                # Armazenar no session_state
+                st.session_state['resultado'] = resultado
+                st.session_state['processado'] = True
+
+                st.success("✅ Processamento concluído com sucesso!")
+
+            except Exception as e:
+                st.error(f"❌ Erro ao processar arquivo: {str(e)}")
+                st.exception(e)
+                return
 
-            st.info("""
-            📋 **O arquivo contém duas abas:**
-            - **Aba 1**: Saldos Ajustados (mesma estrutura da planilha original, com valores corrigidos)
-            - **Aba 2**: Quadro de Remanejamento (detalhamento de todas as transferências realizadas)
-            """)
-
-            # Gerador
-            st.header("7. Gerar Arquivo SIAFE")
-
-            st.markdown("""
-            Gere o arquivo no formato de importação em lote do SIAFE a partir dos
-            remanejamentos calculados. Você precisa fornecer os arquivos de Regras
-            de Mapeamento e preencher os dados obrigatórios.
-            """)
-
-            with st.expander("📤 Configurar e Gerar Arquivo SIAFE", expanded=False):
-                st.subheader("Dados Obrigatórios")
-
-                col_d1, col_d2 = st.columns(2)
-                with col_d1:
-                    data_emissao = st.date_input(
-                        "Data de Emissão",
-                        value=date.today(),
-                        format="DD/MM/YYYY"
-                    )
-                with col_d2:
-                    processo = st.text_input(
-                        "Número do Processo",
-                        value="",
-                        placeholder="Ex: 2026/00001",
-                        help="Número do processo administrativo"
-                    )
-
-                observacao = st.text_input(
-                    "Observação",
-                    value="REMANEJAMENTO FOLHA DE PESSOAL",
-                    help="Texto descritivo para o campo Observação do SIAFE"
-                )
-
-                st.caption("ℹ️ A UG Emitente é preenchida automaticamente com a UG Acrescida (UG Destino) de cada linha.")
-
-                # Botão para gerar
-                gerar_siafe = st.button(
-                    "📄 Gerar Arquivo SIAFE",
-                    type="secondary",
-                    use_container_width=True,
-                )
-
-                if gerar_siafe:
-                    with st.spinner("Gerando arquivo SIAFE..."):
-                        try:
-                            gerador = GeradorLote()
-
-                            # Carregar Regra 41 do diretório assets/
-                            gerador.carregar_regra41(REGRA41_PATH)
-                            st.info(f"📋 Regra 41 carregada: {len(gerador.mapa_ug)} UGs mapeadas")
-
-                            # Carregar Regra 100 do diretório assets/
-                            gerador.carregar_regra100(REGRA100_PATH)
-                            st.info("📋 Regra 100 carregada")
-
-                            # Preparar DataFrame de remanejamentos
-                            df_rem = pd.DataFrame(resultado['remanejamentos'])
-
-                            # Formatar data
-                            data_fmt = data_emissao.strftime("%d/%m/%Y")
-
-                            # Gerar lote
-                            arquivo_siafe, erros = gerador.gerar_lote(
-                                df_remanejamentos=df_rem,
-                                data_emissao=data_fmt,
-                                observacao=observacao,
-                                processo=processo,
-                            )
-
-                            # Exibir erros (se houver)
-                            if erros:
-                                st.markdown(f"**⚠️ {len(erros)} aviso(s) durante a geração:**")
-                                for erro in erros:
-                                    st.warning(erro)
-
-                            # Contar linhas
-                            n_remanejamentos = len(df_rem)
-                            n_linhas_siafe = n_remanejamentos * 2
-
-                            st.success(
-                                f"✅ Arquivo SIAFE gerado com sucesso! "
-                                f"{n_remanejamentos} remanejamentos → {n_linhas_siafe} linhas SIAFE "
-                                f"(Redução + Acréscimo para cada)"
-                            )
-
-                            # Download
-                            st.download_button(
-                                label="📥 Baixar Arquivo SIAFE",
-                                data=arquivo_siafe,
-                                file_name=f"siafe_importacao_{data_emissao.strftime('%Y%m%d')}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                type="primary",
-                                use_container_width=True
-                            )
-
-                        except Exception as e:
-                            st.error(f"❌ Erro ao gerar arquivo SIAFE: {str(e)}")
-                            st.exception(e)
+        # Exibir resultados se já processado
+        if st.session_state.get('processado', False):
+            exibir_resultados(st.session_state['resultado'], uploaded_file.name)
 
     else:
+        # Arquivo removido: descarta o processamento em andamento (ou já concluído) e a fila
+        processamento = st.session_state.pop('processamento', None)
+        if processamento is not None:
+            processamento.cancel()
+        st.session_state.pop('processamento_pendente', None)
+
         st.info("👆 Por favor, faça o upload de uma planilha Excel para começar.")
 
         st.markdown("""
@@ -26,6 +26,14 @@ class GeradorLote:
     EMENDA_PARLAMENTAR = '0000.E0000'
     TERRITORIO = 'TD0'
 
+    # Larguras das colunas
+    LARGURAS_COLUNAS = {
+        'A': 14, 'B': 14, 'C': 12, 'D': 12, 'E': 14, 'F': 14,
+        'G': 30, 'H': 10, 'I': 15, 'J': 10, 'K': 12, 'L': 14,
+        'M': 30, 'N': 8, 'O': 12, 'P': 10, 'Q': 14, 'R': 8,
+        'S': 14, 'T': 16
+    }
+
     def __init__(self):
         self.regra41 = None   # DataFrame da Regra 41
         self.regra100 = None  # DataFrame da Regra 100
@@ -392,40 +400,42 @@ class GeradorLote:
         df_siafe = pd.DataFrame(linhas, columns=self.COLUNAS_SIAFE)
         df_siafe = df_siafe.astype(str)
 
-        # Gerar Excel usando openpyxl diretamente para preservar texto
+        # Gerar Excel usando openpyxl diretamente para preservar texto.
+        # write_only: as linhas são serializadas ao serem anexadas, sem manter células em memória
         output = io.BytesIO()
         from openpyxl import Workbook
-        from openpyxl.utils.dataframe import dataframe_to_rows
+        from openpyxl.cell import WriteOnlyCell
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('SIAFE')
+
+        # Em write_only, larguras precisam ser definidas antes das linhas
+        for col_letter, width in self.LARGURAS_COLUNAS.items():
+            ws.column_dimensions[col_letter].width = width
+
+        # Estilos criados uma única vez e compartilhados por todas as células
+        estilos = self._estilos_planilha()
 
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'SIAFE'
+        def celula(valor, estilo):
+            cell = WriteOnlyCell(ws, value=valor)
+            for atributo, objeto_estilo in estilo.items():
+                setattr(cell, atributo, objeto_estilo)
+            return cell
 
         # Escrever cabeçalho
-        ws.append(list(df_siafe.columns))
+        ws.append([celula(coluna, estilos['cabecalho']) for coluna in df_siafe.columns])
 
         # Escrever dados como texto puro (evitar conversão numérica)
-        for _, row in df_siafe.iterrows():
-            ws.append([str(v) for v in row])
-
-        # Formatar
-        self._formatar_planilha(ws)
+        for row in df_siafe.itertuples(index=False, name=None):
+            ws.append([celula(str(v), estilos['dados']) for v in row])
 
         wb.save(output)
 
         output.seek(0)
         return output.getvalue(), self.erros
 
-    def _formatar_planilha(self, worksheet):
-        """Formata a planilha com estilos visuais."""
-        header_fill = PatternFill(start_color="1F4E79", end_color="1F4E79", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=10)
-
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
+    def _estilos_planilha(self) -> Dict:
+        """Estilos visuais do cabeçalho e das linhas de dados."""
         thin_border = Border(
             left=Side(style='thin'),
             right=Side(style='thin'),
@@ -433,17 +443,15 @@ class GeradorLote:
             bottom=Side(style='thin')
         )
 
-        for row in worksheet.iter_rows():
-            for cell in row:
-                cell.border = thin_border
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        # Larguras das colunas
-        larguras = {
-            'A': 14, 'B': 14, 'C': 12, 'D': 12, 'E': 14, 'F': 14,
-            'G': 30, 'H': 10, 'I': 15, 'J': 10, 'K': 12, 'L': 14,
-            'M': 30, 'N': 8, 'O': 12, 'P': 10, 'Q': 14, 'R': 8,
-            'S': 14, 'T': 16
+        return {
+            'cabecalho': {
+                'fill': PatternFill(start_color="1F4E79", end_color="1F4E79", fill_type="solid"),
+                'font': Font(bold=True, color="FFFFFF", size=10),
+                'alignment': Alignment(horizontal='center', vertical='center'),
+                'border': thin_border,
+            },
+            'dados': {
+                'alignment': Alignment(horizontal='center', vertical='center'),
+                'border': thin_border,
+            },
         }
-        for col_letter, width in larguras.items():
-            worksheet.column_dimensions[col_letter].width = width
@@ -3,17 +3,54 @@ import numpy as np
 from typing import Dict, List, Tuple, Any
 import io
 import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+import xlsxwriter
 import re
+import heapq
+
+
+def alocar_guloso(capacidades: List[float], necessidade: float) -> Tuple[List[Tuple[int, float]], float]:
+    """
+    Distribui a necessidade entre as doadoras, na ordem dada, até cobri-la.
+
+    Retorna as doadoras visitadas como (posição, valor) - valor 0.0 quando a doadora
+    não tem capacidade - e a necessidade que ainda resta.
+    """
+    plano = []
+
+    for posicao, capacidade in enumerate(capacidades):
+        if necessidade <= 0.01:
+            break
+
+        if capacidade <= 0.01:
+            plano.append((posicao, 0.0))
+            continue
+
+        valor = min(necessidade, capacidade)
+        plano.append((posicao, valor))
+
+        # Os saldos são atualizados depois, em registrar_transferencia()
+        necessidade -= valor
+
+    return plano, necessidade
+
+
+COLUNAS_REMANEJAMENTO = ['Tipo', 'Fonte', 'UG Origem', 'Natureza Origem', 'Nome Natureza Origem',
+                         'UG Destino', 'Natureza Destino', 'Nome Natureza Destino', 'Valor',
+                         'ug_origem', 'ug_destino']
 
 
 class ProcessadorOrcamento:
 
-    def __init__(self, fonte_proibida=None, naturezas_proibidas=None):
+    def __init__(self, fonte_proibida=None, naturezas_proibidas=None, log_detalhado=False):
         self.df_original = None
         self.ugs_dados = []
-        self.remanejamentos = []
+        # Remanejamentos como colunas (uma lista por campo), não um dict por transferência;
+        # 'Valor' guarda centavos inteiros (soma exata na consolidação) e volta a reais na saída
+        self.remanejamentos = {coluna: [] for coluna in COLUNAS_REMANEJAMENTO}
+        self._chaves_remanejamento = set()  # Pares origem → destino já registrados (ver gerar_aba_remanejamento)
         self.diagnosticos = []
+        self.total_internos = 0  # Contadores mantidos em registrar_transferencia
+        self.total_externos = 0
 
         # CONFIGURAÇÃO: Colunas importantes
         self.COLUNA_FONTE = 0   # Coluna A: Fonte (500, 501, 761)
@@ -24,8 +61,12 @@ class ProcessadorOrcamento:
         self.FONTE_PROIBIDA = fonte_proibida  # None = nenhuma fonte proibida
 
         # CONFIGURAÇÃO: Naturezas proibidas de remanejamento (passadas como parâmetro)
-        # Se não foi passado, usa conjunto vazio
-        self.NATUREZAS_PROIBIDAS = naturezas_proibidas if naturezas_proibidas else set()
+        # Normalizadas uma vez, no mesmo formato usado na comparação; se não foi passado, usa conjunto vazio
+        self.NATUREZAS_PROIBIDAS = frozenset(self.limpar_codigo_natureza(codigo) for codigo in (naturezas_proibidas or ()))
+        self._proibida_por_codigo = {}  # Cache de natureza_eh_proibida (códigos se repetem entre UGs)
+        if not self.NATUREZAS_PROIBIDAS:
+            # Sem naturezas proibidas, a verificação não precisa nem normalizar o código
+            self.natureza_eh_proibida = lambda codigo_natureza: False
 
         # Processar TODAS as naturezas deficitárias (não apenas linhas de teste)
         self.LINHAS_TESTE = None  # None = processar tudo
@@ -37,10 +78,23 @@ class ProcessadorOrcamento:
         # OTIMIZAÇÃO: Priorizar doação única quando possível
         self.PRIORIZAR_DOACAO_UNICA = True  # Se uma natureza pode cobrir sozinha, usa ela completamente
 
-    def log(self, mensagem):
-        print(f"[DEBUG] {mensagem}")
+        # LOG: diagnóstico detalhado (por natureza / por transferência) e cópia no terminal
+        self.LOG_DETALHADO = log_detalhado  # False = diagnóstico só com o resumo de cada etapa e os alertas
+        self.DEBUG = False  # True = também imprime cada mensagem no terminal
+
+    def log(self, mensagem, *args):
+        # Com args, a mensagem é um modelo de str.format, formatado só aqui
+        if args:
+            mensagem = mensagem.format(*args)
+        if self.DEBUG:
+            print(f"[DEBUG] {mensagem}")
         self.diagnosticos.append(mensagem)
 
+    def log_detalhe(self, mensagem, *args):
+        # Mensagens de alto volume: sem LOG_DETALHADO nem chegam a ser formatadas
+        if self.LOG_DETALHADO:
+            self.log(mensagem, *args)
+
     def processar_arquivo(self, arquivo) -> Dict[str, Any]:
         self.log("=" * 80)
         self.log("INICIANDO PROCESSAMENTO - REGRAS SEFAZ COMPLETAS")
@@ -107,8 +161,8 @@ class ProcessadorOrcamento:
             'estatisticas': {
                 'total_ugs': len(self.ugs_dados),
                 'total_deficits': deficits_totais,
-                'remanejamentos_internos': sum(1 for r in self.remanejamentos if r['ug_origem'] == r['ug_destino']),
-                'remanejamentos_externos': sum(1 for r in self.remanejamentos if r['ug_origem'] != r['ug_destino']),
+                'remanejamentos_internos': self.total_internos,
+                'remanejamentos_externos': self.total_externos,
             },
             'deficits': [
                 {
@@ -116,13 +170,13 @@ class ProcessadorOrcamento:
                     'UG Nome': ug['nome'],
                     'Natureza': nat['codigo'],
                     'Natureza Nome': nat['nome'],
-                    'Déficit': abs(nat['saldo_original'])
+                    'Déficit': nat['deficit_abs']
                 }
                 for ug in self.ugs_dados
                 for nat in ug['naturezas']
-                if nat['saldo_original'] < 0
+                if 'deficit_abs' in nat
             ],
-            'remanejamentos': self.remanejamentos,
+            'remanejamentos': self.remanejamentos_em_reais(),
             'validacoes': validacoes,
             'arquivo_excel': arquivo_excel,
             'diagnosticos': '\n'.join(self.diagnosticos)
@@ -134,7 +188,16 @@ class ProcessadorOrcamento:
         if nome_arquivo.endswith('.xls'):
             df = pd.read_excel(arquivo, sheet_name=0, header=None, engine='xlrd')
         else:
-            df = pd.read_excel(arquivo, sheet_name=0, header=None, engine='openpyxl')
+            # read_only + values_only: lê apenas os valores, sem criar um objeto Cell por célula
+            workbook = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+            try:
+                worksheet = workbook.worksheets[0]
+                # Algumas planilhas exportadas trazem dimensões erradas: ler até a última linha real
+                worksheet.reset_dimensions()
+                linhas = list(worksheet.iter_rows(values_only=True))
+            finally:
+                workbook.close()
+            df = pd.DataFrame(linhas)
 
         df = df.reset_index(drop=True)
         return df
@@ -143,9 +206,8 @@ class ProcessadorOrcamento:
         if self.df_original is None:
             raise Exception("Planilha não carregada!")
 
-        # Procurar nas primeiras 10 linhas pelo cabeçalho
-        for linha_idx in range(min(10, len(self.df_original))):
-            row = self.df_original.iloc[linha_idx]
+        # Procurar nas primeiras 10 linhas pelo cabeçalho (valores crus, sem criar uma Series por linha)
+        for row in self.df_original.iloc[:10].to_numpy():
             for col_idx, valor in enumerate(row):
                 if pd.isna(valor):
                     continue
@@ -171,120 +233,210 @@ class ProcessadorOrcamento:
 
         COLUNA_B = 1  # Coluna B = índice 1
 
+        # Colunas numéricas convertidas de uma vez, indexadas pela linha
+        saldos = self.extrair_coluna_numerica(self.COLUNA_SALDO).tolist()
+        fontes = self.extrair_coluna_numerica(self.COLUNA_FONTE).tolist()
+
         ug_atual = None
         fonte_atual = None  # Rastreia a última fonte válida vista (coluna A pode ter células mescladas)
 
-        for idx, row in self.df_original.iterrows():
-            # Ler valor da coluna B
-            if COLUNA_B >= len(row):
-                continue
-
-            valor_b = row.iloc[COLUNA_B]
-
-            if pd.isna(valor_b):
-                continue
-
-            valor_str = str(valor_b).strip()
-            match = padrao_geral.match(valor_str)
+        # Apenas as linhas cuja coluna B segue o padrão de UG/Natureza (extração vetorizada)
+        if COLUNA_B < len(self.df_original.columns):
+            coluna_b = self.df_original.iloc[:, COLUNA_B]
+            textos = coluna_b[coluna_b.notna()].astype(str).str.strip()
+            encontrados = textos.str.extract(padrao_geral).dropna()
+        else:
+            encontrados = pd.DataFrame(columns=[0, 1])
+
+        codigos = encontrados[0]
+        nomes = encontrados[1].str.strip()
+
+        # Verificar se é UG ou Natureza (para todas as linhas de uma vez)
+        # UG: nome em MAIÚSCULAS
+        # Natureza: nome com minúsculas
+        eh_ug = nomes == nomes.str.upper()
+
+        for idx, codigo, nome, linha_eh_ug in zip(encontrados.index.tolist(), codigos.tolist(), nomes.tolist(), eh_ug.tolist()):
+            if linha_eh_ug:
+                # É UG
+                saldo = saldos[idx]
+                fonte = fontes[idx]
+
+                # Atualiza fonte_atual se a coluna A tiver valor (células mescladas: só a 1ª tem valor)
+                if fonte > 0:
+                    fonte_atual = int(fonte)
+
+                ug_atual = {
+                    'codigo': codigo,
+                    'nome': nome,
+                    'linha': idx,
+                    'linha_excel': idx + 1,
+                    'saldo_total': saldo,
+                    'fonte': fonte_atual,
+                    'naturezas': []
+                }
 
-            if match:
-                codigo = match.group(1)
-                nome = match.group(2).strip()
+                self.ugs_dados.append(ug_atual)
 
-                # Verificar se é UG ou Natureza
-                # UG: nome em MAIÚSCULAS
-                # Natureza: nome com minúsculas
-                if nome == nome.upper():
-                    # É UG
-                    saldo = self.extrair_valor_coluna(row, self.COLUNA_SALDO)
-                    fonte = self.extrair_valor_coluna(row, self.COLUNA_FONTE)
+                fonte_str = f"Fonte: {fonte_atual}" if fonte_atual else "Sem fonte"
+                status = "DÉFICIT" if saldo < 0 else "SUPERÁVIT" if saldo > 0 else "ZERO"
+                self.log_detalhe("   UG: {} - {} ({}) (linha {}) | Saldo: {:,.2f} ({})", codigo, nome, fonte_str, idx + 1, saldo, status)
 
-                    # Atualiza fonte_atual se a coluna A tiver valor (células mescladas: só a 1ª tem valor)
-                    if fonte > 0:
-                        fonte_atual = int(fonte)
+            else:
+                # É Natureza
+                if ug_atual is not None:
+                    saldo = saldos[idx]
+                    fonte = fontes[idx]
 
-                    ug_atual = {
+                    natureza = {
                         'codigo': codigo,
                         'nome': nome,
                         'linha': idx,
                         'linha_excel': idx + 1,
-                        'saldo_total': saldo,
-                        'fonte': fonte_atual,
-                        'naturezas': []
+                        'saldo_original': saldo,
+                        'saldo_atual': saldo,
+                        'dois_primeiros_digitos': int(codigo[:2]),  # Para priorização (inteiro: comparação direta)
+                        'fonte': int(fonte) if fonte > 0 else ug_atual['fonte'],  # Herda fonte da UG
+                        'proibida': self.natureza_eh_proibida(codigo)  # Verificado uma única vez
                     }
 
-                    self.ugs_dados.append(ug_atual)
+                    if saldo < 0:
+                        natureza['deficit_abs'] = -saldo  # Déficit em valor absoluto, calculado uma vez
 
-                    fonte_str = f"Fonte: {fonte_atual}" if fonte_atual else "Sem fonte"
-                    status = "DÉFICIT" if saldo < 0 else "SUPERÁVIT" if saldo > 0 else "ZERO"
-                    self.log(f"   UG: {codigo} - {nome} ({fonte_str}) (linha {idx + 1}) | Saldo: {saldo:,.2f} ({status})")
+                    ug_atual['naturezas'].append(natureza)
 
-                else:
-                    # É Natureza
-                    if ug_atual is not None:
-                        saldo = self.extrair_valor_coluna(row, self.COLUNA_SALDO)
-                        fonte = self.extrair_valor_coluna(row, self.COLUNA_FONTE)
-
-                        natureza = {
-                            'codigo': codigo,
-                            'nome': nome,
-                            'linha': idx,
-                            'linha_excel': idx + 1,
-                            'saldo_original': saldo,
-                            'saldo_atual': saldo,
-                            'dois_primeiros_digitos': codigo[:2],  # Para priorização
-                            'fonte': int(fonte) if fonte > 0 else ug_atual['fonte']  # Herda fonte da UG
-                        }
-
-                        ug_atual['naturezas'].append(natureza)
-
-                        status = "DÉFICIT" if saldo < 0 else "SUPERÁVIT" if saldo > 0 else "ZERO"
-                        self.log(f"      Natureza: {codigo} - {nome[:40]}... (linha {idx + 1}) | Saldo: {saldo:,.2f} ({status})")
+                    status = "DÉFICIT" if saldo < 0 else "SUPERÁVIT" if saldo > 0 else "ZERO"
+                    self.log_detalhe("      Natureza: {} - {}... (linha {}) | Saldo: {:,.2f} ({})", codigo, nome[:40], idx + 1, saldo, status)
 
         # Processar TODAS as naturezas (sem filtro de linhas de teste)
         self.log(f"\n   Modo: Processar TODAS as naturezas deficitárias encontradas")
 
-    def extrair_valor_coluna(self, row, coluna_idx) -> float:
-        if coluna_idx >= len(row):
-            return 0.0
+        self.montar_colunas()
 
-        valor = row.iloc[coluna_idx]
+    def montar_colunas(self):
+        # Estrutura em colunas (um array NumPy por campo, uma posição por natureza)
+        # usada nos filtros e cálculos; os dicts continuam servindo para log e relatórios
+        self._naturezas = []
+        fontes_ug = []
+        ug_ids = []
 
-        if pd.isna(valor):
-            return 0.0
+        for ug_id, ug in enumerate(self.ugs_dados):
+            inicio = len(self._naturezas)
+            for nat in ug['naturezas']:
+                nat['indice'] = len(self._naturezas)
+                self._naturezas.append(nat)
+                fontes_ug.append(ug['fonte'])
+                ug_ids.append(ug_id)
+            ug['indices'] = np.arange(inicio, len(self._naturezas))
+
+            # Soma dos saldos das naturezas, mantida em registrar_transferencia a cada doação
+            ug['saldo_total_ajustado'] = sum(nat['saldo_atual'] for nat in ug['naturezas'])
+
+        naturezas = self._naturezas
+        fonte_proibida = self.codigo_fonte(self.FONTE_PROIBIDA)
+
+        self._colunas = {
+            'saldo_original': np.array([nat['saldo_original'] for nat in naturezas], dtype=np.float64),
+            'saldo_atual': np.array([nat['saldo_atual'] for nat in naturezas], dtype=np.float64),
+            'fonte': np.array([self.codigo_fonte(nat['fonte']) for nat in naturezas], dtype=np.int64),
+            'fonte_ug': np.array([self.codigo_fonte(fonte) for fonte in fontes_ug], dtype=np.int64),
+            'digitos2': np.array([nat['dois_primeiros_digitos'] for nat in naturezas], dtype=np.uint8),
+            'ug_id': np.array(ug_ids, dtype=np.int32),
+            'proibida': np.array([nat['proibida'] for nat in naturezas], dtype=bool),
+            'necessidade': np.zeros(len(naturezas), dtype=np.float64),  # Preenchida em identificar_deficits
+        }
+        self._colunas['deficit'] = np.maximum(-self._colunas['saldo_original'], 0.0)
+        # Saldo mínimo a preservar (20% do original): constante por natureza, calculado uma vez
+        self._colunas['saldo_minimo'] = self._colunas['saldo_original'] * self.PERCENTUAL_RESERVA_MINIMA
 
-        try:
-            if isinstance(valor, (int, float)):
-                return float(valor)
-            else:
-                valor_str = str(valor).strip().replace(',', '.')
-                return float(valor_str)
-        except:
-            return 0.0
+        # Naturezas que podem participar de remanejamento (fora da fonte proibida e da lista de proibidas)
+        # (a comparação de fonte nunca é dispensável: sem fonte proibida, None == None ainda exclui as naturezas sem fonte)
+        self._colunas['participa'] = self._colunas['fonte'] != fonte_proibida
+        if self.NATUREZAS_PROIBIDAS:
+            self._colunas['participa'] &= ~self._colunas['proibida']
+
+        self.montar_indices()
+
+    def montar_indices(self):
+        # Índices (globais) de quem pode receber e de quem pode doar, calculados uma única vez:
+        # apenas naturezas originalmente negativas recebem e originalmente positivas doam
+        colunas = self._colunas
+        elegivel = colunas['participa'] & (colunas['fonte_ug'] != self.codigo_fonte(self.FONTE_PROIBIDA))
+
+        self._indices_deficit = np.flatnonzero(elegivel & (colunas['saldo_original'] < 0))
+        self._indices_superavit = np.flatnonzero(elegivel & (colunas['saldo_original'] > 0))
+
+        # Fatias por UG (as naturezas de cada UG são contíguas)
+        inicios = np.cumsum([len(ug['naturezas']) for ug in self.ugs_dados])[:-1]
+        por_ug_deficit = np.split(self._indices_deficit, np.searchsorted(self._indices_deficit, inicios))
+        por_ug_superavit = np.split(self._indices_superavit, np.searchsorted(self._indices_superavit, inicios))
+
+        for ug, indices_deficit, indices_superavit in zip(self.ugs_dados, por_ug_deficit, por_ug_superavit):
+            ug['indices_deficit'] = indices_deficit
+            ug['indices_superavit'] = indices_superavit
+
+        # UGs agrupadas por fonte (na ordem da planilha) para achar doadoras da mesma fonte,
+        # e por código (se houver código repetido, vale a primeira UG, como na busca linear)
+        self._ugs_por_fonte = {}
+        self._ugs_por_codigo = {}
+        for ug in self.ugs_dados:
+            self._ugs_por_fonte.setdefault(ug['fonte'], []).append(ug)
+            self._ugs_por_codigo.setdefault(ug['codigo'], ug)
+
+    def codigo_fonte(self, fonte) -> int:
+        # Fonte ausente (None) vira -1 nos arrays; None == None continua valendo como "mesma fonte"
+        return -1 if fonte is None else int(fonte)
+
+    def extrair_coluna_numerica(self, coluna_idx) -> np.ndarray:
+        # Converte a coluna inteira de uma vez; células vazias ou que não são número viram 0.0
+        if coluna_idx >= len(self.df_original.columns):
+            return np.zeros(len(self.df_original))
+
+        serie = self.df_original.iloc[:, coluna_idx]
+        if serie.dtype == object:
+            eh_texto = serie.map(lambda valor: isinstance(valor, str)).to_numpy(dtype=bool)
+        else:
+            eh_texto = np.zeros(len(serie), dtype=bool)
+
+        valores = pd.to_numeric(serie.where(~eh_texto), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        valores[np.isnan(valores)] = 0.0
+
+        # Textos (ex.: "1234,56"): vírgula vira ponto; float() mantém a conversão exata
+        celulas = serie.to_numpy()
+        for i in np.flatnonzero(eh_texto):
+            try:
+                valores[i] = float(celulas[i].strip().replace(',', '.'))
+            except ValueError:
+                valores[i] = 0.0
+
+        return valores
 
     def natureza_eh_proibida(self, codigo_natureza: str) -> bool:
+        proibida = self._proibida_por_codigo.get(codigo_natureza)
+        if proibida is None:
+            proibida = self.limpar_codigo_natureza(codigo_natureza) in self.NATUREZAS_PROIBIDAS
+            self._proibida_por_codigo[codigo_natureza] = proibida
+        return proibida
+
+    @staticmethod
+    def limpar_codigo_natureza(codigo) -> str:
         # Remover pontos e espaços para comparação
-        codigo_limpo = codigo_natureza.replace('.', '').replace(' ', '').strip()
-        return codigo_limpo in self.NATUREZAS_PROIBIDAS
+        return str(codigo).replace('.', '').replace(' ', '').strip()
 
-    def calcular_capacidade_doacao(self, natureza: Dict) -> float:
+    def capacidade_doacao(self, indices) -> np.ndarray:
         """
-        Calcula quanto uma natureza pode doar, respeitando o saldo mínimo de segurança.
+        Calcula quanto cada natureza (índices nas colunas) pode doar, respeitando o saldo mínimo de segurança.
 
         REGRAS:
         1. Preservar no mínimo 20% do saldo original
         2. Doar no máximo 10% do saldo original por vez (para UGs grandes)
         3. Nunca zerar uma natureza positiva
         """
-        saldo_original = natureza['saldo_original']
-        saldo_atual = natureza['saldo_atual']
-
-        # Se já não tem saldo positivo, não pode doar nada
-        if saldo_atual <= 0:
-            return 0.0
+        saldo_original = self._colunas['saldo_original'][indices]
+        saldo_atual = self._colunas['saldo_atual'][indices]
 
-        # Calcular saldo mínimo a preservar (20% do original)
-        saldo_minimo = saldo_original * self.PERCENTUAL_RESERVA_MINIMA
+        # Saldo mínimo a preservar (20% do original), pré-calculado em montar_colunas
+        saldo_minimo = self._colunas['saldo_minimo'][indices]
 
         # Calcular máximo que pode doar (80% do original)
         capacidade_maxima = saldo_original - saldo_minimo
@@ -296,53 +448,58 @@ class ProcessadorOrcamento:
         quanto_ja_doou = saldo_original - saldo_atual
 
         # Quanto ainda pode doar (respeitando limite de 80% total)
-        quanto_ainda_pode_doar = max(0, capacidade_maxima - quanto_ja_doou)
+        quanto_ainda_pode_doar = np.maximum(0, capacidade_maxima - quanto_ja_doou)
 
         # Limitar pela regra de 10% por vez
-        capacidade_real = min(quanto_ainda_pode_doar, doacao_maxima_por_vez)
+        capacidade_real = np.minimum(quanto_ainda_pode_doar, doacao_maxima_por_vez)
 
         # Garantir que não vai ultrapassar o saldo atual
-        capacidade_real = min(capacidade_real, saldo_atual - saldo_minimo)
+        capacidade_real = np.minimum(capacidade_real, saldo_atual - saldo_minimo)
 
-        return max(0, capacidade_real)
+        # Se já não tem saldo positivo, não pode doar nada
+        return np.where(saldo_atual <= 0, 0.0, np.maximum(0, capacidade_real))
 
     def identificar_deficits(self) -> int:
-        total_deficits = 0
         ignorados_761 = 0
         ignorados_naturezas_proibidas = 0
 
+        colunas = self._colunas
+        fonte_proibida = self.codigo_fonte(self.FONTE_PROIBIDA)
+
+        # Necessidade inicial = exatamente o déficit, para todas as deficitárias de uma vez
+        colunas['necessidade'][self._indices_deficit] = colunas['deficit'][self._indices_deficit]
+        total_deficits = len(self._indices_deficit)
+
+        # Naturezas negativas que só não entram por estarem na lista de proibidas (apenas para o log)
+        negativas = colunas['saldo_original'] < 0
+        tem_proibidas = bool(colunas['proibida'].any())
+        if tem_proibidas:
+            eh_proibida = negativas & (colunas['fonte_ug'] != fonte_proibida) & (colunas['fonte'] != fonte_proibida) & colunas['proibida']
+
         for ug in self.ugs_dados:
+            indices = ug['indices']
+
             if ug['fonte'] == self.FONTE_PROIBIDA:
-                deficits_761 = [nat for nat in ug['naturezas'] if nat['saldo_original'] < 0]
-                if deficits_761:
-                    ignorados_761 += len(deficits_761)
-                    self.log(f"\n   UG {ug['codigo']} (Fonte 761): {len(deficits_761)} déficit(s) IGNORADOS (fonte proibida)")
+                qtd_deficits_761 = int(np.count_nonzero(negativas[indices]))
+                if qtd_deficits_761:
+                    ignorados_761 += qtd_deficits_761
+                    self.log(f"\n   UG {ug['codigo']} (Fonte 761): {qtd_deficits_761} déficit(s) IGNORADOS (fonte proibida)")
                 continue
 
-            # TODAS as naturezas com saldo negativo
-            deficits_ug = []
-            for nat in ug['naturezas']:
-                if nat['saldo_original'] >= 0:
-                    continue
-                if nat['fonte'] == self.FONTE_PROIBIDA:
-                    continue
-
-                # Verificar se é natureza proibida
-                if self.natureza_eh_proibida(nat['codigo']):
+            # Verificar se é natureza proibida
+            if tem_proibidas:
+                for i in indices[eh_proibida[indices]]:
                     ignorados_naturezas_proibidas += 1
-                    self.log(f"\n   UG {ug['codigo']} - Natureza {nat['codigo']}: IGNORADA (natureza proibida - responsabilidade da UG)")
-                    continue
+                    self.log(f"\n   UG {ug['codigo']} - Natureza {self._naturezas[i]['codigo']}: IGNORADA (natureza proibida - responsabilidade da UG)")
 
-                deficits_ug.append(nat)
+            # TODAS as naturezas com saldo negativo, fora da fonte proibida (na UG e na natureza)
+            deficits_ug = [self._naturezas[i] for i in ug['indices_deficit']]
 
             if deficits_ug:
                 self.log(f"\n   UG {ug['codigo']} - {ug['nome']} (Fonte: {ug['fonte']}): {len(deficits_ug)} déficit(s)")
                 for nat in deficits_ug:
-                    deficit_puro = abs(nat['saldo_original'])
-                    nat['necessidade_total'] = deficit_puro  # Exatamente o déficit
-                    self.log(f"      • {nat['codigo']} (linha {nat['linha_excel']}, Fonte: {nat['fonte']}) - {nat['nome'][:40]}...")
-                    self.log(f"        Déficit: {deficit_puro:,.2f}")
-                    total_deficits += 1
+                    self.log_detalhe("      • {} (linha {}, Fonte: {}) - {}...", nat['codigo'], nat['linha_excel'], nat['fonte'], nat['nome'][:40])
+                    self.log_detalhe("        Déficit: {:,.2f}", nat['deficit_abs'])
 
         if ignorados_761 > 0:
             self.log(f"\n   ⚠️ {ignorados_761} déficit(s) da Fonte 761 foram IGNORADOS")
@@ -364,17 +521,14 @@ class ProcessadorOrcamento:
 
             self.log(f"\n   Processando UG {ug['codigo']} - {ug['nome']} (Fonte: {ug['fonte']})...")
 
+            # Antes do remanejamento interno da UG os saldos atuais ainda são os originais,
+            # então as listas pré-calculadas valem aqui
             # Deficitárias: TODAS com saldo negativo (exceto fonte 761 e naturezas proibidas)
-            deficitarias = [nat for nat in ug['naturezas']
-                           if nat['saldo_atual'] < 0
-                           and nat['fonte'] != self.FONTE_PROIBIDA
-                           and not self.natureza_eh_proibida(nat['codigo'])]
+            deficitarias = [self._naturezas[i] for i in ug['indices_deficit']]
 
             # Superavitárias: TODAS as naturezas da UG com saldo positivo (exceto fonte 761 e naturezas proibidas)
-            superavitarias = [nat for nat in ug['naturezas']
-                             if nat['saldo_atual'] > 0
-                             and nat['fonte'] != self.FONTE_PROIBIDA
-                             and not self.natureza_eh_proibida(nat['codigo'])]
+            indices_super = ug['indices_superavit']
+            superavitarias = [self._naturezas[i] for i in indices_super]
 
             if not deficitarias:
                 self.log(f"      Sem déficits")
@@ -387,91 +541,73 @@ class ProcessadorOrcamento:
             self.log(f"      Déficits a cobrir: {len(deficitarias)}")
             self.log(f"      Naturezas doadoras disponíveis: {len(superavitarias)}")
 
+            # Ordenar por saldo (maior primeiro) e agrupar por dígitos uma vez por UG;
+            # depois de cada déficit só as doadoras que doaram são reposicionadas
+            doadoras_ug = self.agrupar_doadoras(indices_super)
+
             # Mostrar naturezas doadoras
             if superavitarias:
                 self.log(f"\n      Naturezas doadoras:")
-                for nat_super in sorted(superavitarias, key=lambda x: x['saldo_atual'], reverse=True):
-                    self.log(f"         • {nat_super['codigo']}: {nat_super['saldo_atual']:,.2f} (dígitos: {nat_super['dois_primeiros_digitos']})")
+                for nat_super in (self._naturezas[i] for i in doadoras_ug['ordem']):
+                    self.log_detalhe("         • {}: {:,.2f} (dígitos: {:02d})", nat_super['codigo'], nat_super['saldo_atual'], nat_super['dois_primeiros_digitos'])
 
             # Para cada déficit
+            necessidades = self._colunas['necessidade']
             for nat_deficit in deficitarias:
-                necessidade_restante = nat_deficit.get('necessidade_total', abs(nat_deficit['saldo_atual']))
+                necessidade_restante = float(necessidades[nat_deficit['indice']])
 
                 if necessidade_restante <= 0.01:
                     continue
 
-                digitos_deficit = nat_deficit['dois_primeiros_digitos']
-
-                self.log(f"\n      Cobrindo déficit: {nat_deficit['codigo']} - {nat_deficit['nome'][:40]}...")
-                self.log(f"         Necessidade: {necessidade_restante:,.2f}")
+                digitos_deficit = self._colunas['digitos2'][nat_deficit['indice']]
 
-                # PRIORIDADE: Mesmos 2 primeiros dígitos
-                doadoras_prioritarias = [s for s in superavitarias if s['dois_primeiros_digitos'] == digitos_deficit]
-                doadoras_secundarias = [s for s in superavitarias if s['dois_primeiros_digitos'] != digitos_deficit]
+                self.log_detalhe("\n      Cobrindo déficit: {} - {}...", nat_deficit['codigo'], nat_deficit['nome'][:40])
+                self.log_detalhe("         Necessidade: {:,.2f}", necessidade_restante)
 
-                # Ordenar por saldo (maior primeiro)
-                doadoras_prioritarias.sort(key=lambda x: x['saldo_atual'], reverse=True)
-                doadoras_secundarias.sort(key=lambda x: x['saldo_atual'], reverse=True)
+                # PRIORIDADE: Mesmos 2 primeiros dígitos, depois as demais; cada grupo por maior saldo
+                # Cada doadora é visitada uma única vez por déficit, então as capacidades
+                # calculadas aqui de uma vez continuam válidas durante todo o laço
+                doadoras, mesmos_digitos = self.separar_prioritarias(doadoras_ug, digitos_deficit)
+                capacidades = self.capacidade_doacao(doadoras).tolist()
 
                 # OTIMIZAÇÃO: Verificar se UMA única natureza pode cobrir tudo
                 doadora_unica = None
                 if self.PRIORIZAR_DOACAO_UNICA:
-                    for nat_super in doadoras_prioritarias + doadoras_secundarias:
-                        capacidade = self.calcular_capacidade_doacao(nat_super)
-                        if capacidade >= necessidade_restante:
-                            doadora_unica = nat_super
-                            self.log(f"         ✓ Doadora única encontrada: {nat_super['codigo']} (capacidade: {capacidade:,.2f})")
-                            break
+                    cobrem_tudo = np.flatnonzero(np.asarray(capacidades) >= necessidade_restante)
+                    if len(cobrem_tudo):
+                        doadora_unica = self._naturezas[doadoras[cobrem_tudo[0]]]
+                        self.log_detalhe("         ✓ Doadora única encontrada: {} (capacidade: {:,.2f})", doadora_unica['codigo'], capacidades[cobrem_tudo[0]])
 
                 # Se encontrou doadora única, usar ela
                 if doadora_unica:
-                    self.log(f"         • {doadora_unica['codigo']}: cobrindo TUDO em uma única transferência")
+                    self.log_detalhe("         • {}: cobrindo TUDO em uma única transferência", doadora_unica['codigo'])
                     self.registrar_transferencia(ug['codigo'], doadora_unica, ug['codigo'], nat_deficit, necessidade_restante, "Interna (única)")
                     necessidade_restante = 0
+                    self.reposicionar_doadoras(doadoras_ug, [doadora_unica['indice']])
                 else:
-                    # Caso contrário, distribuir entre várias (lógica atual)
-                    # Tentar doadoras prioritárias primeiro
-                    for nat_super in doadoras_prioritarias:
-                        if necessidade_restante <= 0.01:
-                            break
-
-                        # NOVA REGRA: Calcular capacidade real de doação (respeitando saldo mínimo)
-                        capacidade_doacao = self.calcular_capacidade_doacao(nat_super)
-
-                        if capacidade_doacao <= 0.01:
-                            self.log(f"         • {nat_super['codigo']}: sem capacidade de doação (preservando saldo mínimo)")
-                            continue
-
-                        valor_transferir = min(necessidade_restante, capacidade_doacao)
-
-                        self.log(f"         • {nat_super['codigo']}: pode doar {capacidade_doacao:,.2f}, transferindo {valor_transferir:,.2f}")
-                        self.registrar_transferencia(ug['codigo'], nat_super, ug['codigo'], nat_deficit, valor_transferir, "Interna (mesmos dígitos)")
-
-                        # Saldos já atualizados dentro de registrar_transferencia()
-                        necessidade_restante -= valor_transferir
-
-                    # Se ainda não cobriu, usar doadoras secundárias
-                    for nat_super in doadoras_secundarias:
-                        if necessidade_restante <= 0.01:
-                            break
+                    # Caso contrário, distribuir entre várias: prioritárias primeiro, depois secundárias
+                    plano, necessidade_restante = alocar_guloso(capacidades, necessidade_restante)
+                    alteradas = []
 
-                        # Calcular capacidade real de doação (respeitando saldo mínimo)
-                        capacidade_doacao = self.calcular_capacidade_doacao(nat_super)
+                    for posicao, valor_transferir in plano:
+                        nat_super = self._naturezas[doadoras[posicao]]
 
-                        if capacidade_doacao <= 0.01:
-                            self.log(f"         • {nat_super['codigo']}: sem capacidade de doação (preservando saldo mínimo)")
+                        if valor_transferir == 0:
+                            self.log_detalhe("         • {}: sem capacidade de doação (preservando saldo mínimo)", nat_super['codigo'])
                             continue
 
-                        valor_transferir = min(necessidade_restante, capacidade_doacao)
+                        tipo = "Interna (mesmos dígitos)" if mesmos_digitos[posicao] else "Interna"
 
-                        self.log(f"         • {nat_super['codigo']}: pode doar {capacidade_doacao:,.2f}, transferindo {valor_transferir:,.2f}")
-                        self.registrar_transferencia(ug['codigo'], nat_super, ug['codigo'], nat_deficit, valor_transferir, "Interna")
+                        self.log_detalhe("         • {}: pode doar {:,.2f}, transferindo {:,.2f}", nat_super['codigo'], capacidades[posicao], valor_transferir)
+                        self.registrar_transferencia(ug['codigo'], nat_super, ug['codigo'], nat_deficit, valor_transferir, tipo)
+                        alteradas.append(nat_super['indice'])
 
-                    # Saldos já atualizados dentro de registrar_transferencia()
-                    necessidade_restante -= valor_transferir
+                    # Saldos mudaram: reposicionar as doadoras antes do próximo déficit
+                    if alteradas:
+                        self.reposicionar_doadoras(doadoras_ug, alteradas)
 
                 # Atualizar necessidade
-                nat_deficit['necessidade_total'] = max(0, necessidade_restante)
+                necessidades[nat_deficit['indice']] = max(0, necessidade_restante)
 
                 if necessidade_restante > 0.01:
                     self.log(f"         ⚠️ ATENÇÃO: Ainda falta {necessidade_restante:,.2f} para cobrir totalmente")
@@ -481,6 +617,7 @@ class ProcessadorOrcamento:
 
         # Identificar déficits residuais (exceto fonte 761)
         # IMPORTANTE: Apenas naturezas que eram ORIGINALMENTE negativas podem receber
+        necessidades = self._colunas['necessidade']
         ugs_deficitarias = []
         for ug in self.ugs_dados:
             # Ignorar fonte 761
@@ -488,14 +625,12 @@ class ProcessadorOrcamento:
                 continue
 
             # Apenas naturezas que COMEÇARAM negativas e ainda precisam de cobertura (exceto proibidas)
-            deficits = [nat for nat in ug['naturezas']
-                       if nat['saldo_original'] < 0  # DEVE ter começado negativa
-                       and nat.get('necessidade_total', 0) > 0.01  # E ainda precisar de cobertura
-                       and nat['fonte'] != self.FONTE_PROIBIDA
-                       and not self.natureza_eh_proibida(nat['codigo'])]  # Excluir naturezas proibidas
+            indices_deficit = ug['indices_deficit']
+            indices_deficit = indices_deficit[necessidades[indices_deficit] > 0.01]  # E ainda precisar de cobertura
+            deficits = [self._naturezas[i] for i in indices_deficit]
 
             if deficits:
-                total_necessidade = sum(nat.get('necessidade_total', abs(nat['saldo_atual'])) for nat in deficits)
+                total_necessidade = sum(necessidades[indices_deficit].tolist())
                 ugs_deficitarias.append({
                     'ug': ug,
                     'fonte': ug['fonte'],
@@ -514,34 +649,27 @@ class ProcessadorOrcamento:
 
             self.log(f"\n   Buscando doadoras da Fonte {fonte_deficitaria} para UG {ug_deficit_info['ug']['codigo']}...")
 
-            # Identificar UGs doadoras da MESMA FONTE (exceto fonte 761)
+            # Identificar UGs doadoras da MESMA FONTE (a fonte 761 nunca chega aqui como deficitária)
             ugs_doadoras = []
-            for ug in self.ugs_dados:
-                # Ignorar fonte 761
-                if ug['fonte'] == self.FONTE_PROIBIDA:
-                    continue
-
-                # Apenas mesma fonte
-                if ug['fonte'] != fonte_deficitaria:
-                    continue
-
+            for ug in self._ugs_por_fonte[fonte_deficitaria]:
                 # Não pode ser a própria UG deficitária
                 if ug['codigo'] == ug_deficit_info['ug']['codigo']:
                     continue
 
-                # Naturezas com saldo positivo (exceto naturezas proibidas)
-                naturezas_super = [nat for nat in ug['naturezas']
-                                  if nat['saldo_atual'] > 0
-                                  and nat['fonte'] != self.FONTE_PROIBIDA
-                                  and not self.natureza_eh_proibida(nat['codigo'])]
+                # Naturezas originalmente positivas (exceto naturezas proibidas); a reserva
+                # mínima garante que continuam com saldo positivo depois de doar
+                indices_super = ug['indices_superavit']
+                naturezas_super = [self._naturezas[i] for i in indices_super]
 
                 if naturezas_super:
-                    total_super = sum(nat['saldo_atual'] for nat in naturezas_super)
+                    total_super = sum(self._colunas['saldo_atual'][indices_super].tolist())
                     ugs_doadoras.append({
                         'ug': ug,
                         'fonte': ug['fonte'],
                         'superavit_total': total_super,
-                        'naturezas_super': naturezas_super
+                        'naturezas_super': naturezas_super,
+                        'indices_super': indices_super,
+                        'doadoras_ug': None
                     })
 
             if not ugs_doadoras:
@@ -553,252 +681,346 @@ class ProcessadorOrcamento:
 
             self.log(f"      UGs doadoras encontradas (Fonte {fonte_deficitaria}):")
             for ud in ugs_doadoras:
-                self.log(f"         • UG {ud['ug']['codigo']}: {ud['superavit_total']:,.2f} disponível")
+                self.log_detalhe("         • UG {}: {:,.2f} disponível", ud['ug']['codigo'], ud['superavit_total'])
 
             # Realizar transferências para esta UG deficitária
             for nat_deficit in ug_deficit_info['naturezas_deficit']:
-                necessidade_restante = nat_deficit.get('necessidade_total', abs(nat_deficit['saldo_atual']))
+                necessidade_restante = float(necessidades[nat_deficit['indice']])
 
                 if necessidade_restante <= 0.01:
                     continue
 
-                digitos_deficit = nat_deficit['dois_primeiros_digitos']
+                digitos_deficit = self._colunas['digitos2'][nat_deficit['indice']]
 
                 # Buscar em UGs doadoras DA MESMA FONTE, priorizando MAIOR saldo
                 for ug_doadora_info in ugs_doadoras:
                     if necessidade_restante <= 0.01:
                         break
 
-                    # Separar por prioridade
-                    prioritarias = [s for s in ug_doadora_info['naturezas_super']
-                                  if s['dois_primeiros_digitos'] == digitos_deficit]
-                    secundarias = [s for s in ug_doadora_info['naturezas_super']
-                                 if s['dois_primeiros_digitos'] != digitos_deficit]
-
-                    prioritarias.sort(key=lambda x: x['saldo_atual'], reverse=True)
-                    secundarias.sort(key=lambda x: x['saldo_atual'], reverse=True)
-
-                    # Tentar prioritárias
-                    for nat_super in prioritarias:
-                        if necessidade_restante <= 0.01:
-                            break
-
-                        # NOVA REGRA: Calcular capacidade real de doação (respeitando saldo mínimo)
-                        capacidade_doacao = self.calcular_capacidade_doacao(nat_super)
-
-                        if capacidade_doacao <= 0.01:
-                            continue
-
-                        valor_transferir = min(necessidade_restante, capacidade_doacao)
-
-                        self.registrar_transferencia(
-                            ug_doadora_info['ug']['codigo'], nat_super,
-                            ug_deficit_info['ug']['codigo'], nat_deficit,
-                            valor_transferir, "Externa (mesmos dígitos)"
-                        )
+                    # Ordenação por saldo montada na primeira vez que a UG é consultada
+                    if ug_doadora_info['doadoras_ug'] is None:
+                        ug_doadora_info['doadoras_ug'] = self.agrupar_doadoras(ug_doadora_info['indices_super'])
 
-                        # Saldos já atualizados dentro de registrar_transferencia()
-                        necessidade_restante -= valor_transferir
+                    # Separar por prioridade: prioritárias primeiro, depois secundárias
+                    doadoras, mesmos_digitos = self.separar_prioritarias(ug_doadora_info['doadoras_ug'], digitos_deficit)
 
-                    # Tentar secundárias
-                    for nat_super in secundarias:
-                        if necessidade_restante <= 0.01:
-                            break
+                    # NOVA REGRA: Calcular capacidade real de doação (respeitando saldo mínimo)
+                    capacidades = self.capacidade_doacao(doadoras).tolist()
 
-                        # NOVA REGRA: Calcular capacidade real de doação (respeitando saldo mínimo)
-                        capacidade_doacao = self.calcular_capacidade_doacao(nat_super)
+                    plano, necessidade_restante = alocar_guloso(capacidades, necessidade_restante)
+                    alteradas = []
 
-                        if capacidade_doacao <= 0.01:
+                    for posicao, valor_transferir in plano:
+                        if valor_transferir == 0:
                             continue
 
-                        valor_transferir = min(necessidade_restante, capacidade_doacao)
-
                         self.registrar_transferencia(
-                            ug_doadora_info['ug']['codigo'], nat_super,
+                            ug_doadora_info['ug']['codigo'], self._naturezas[doadoras[posicao]],
                             ug_deficit_info['ug']['codigo'], nat_deficit,
-                            valor_transferir, "Externa"
+                            valor_transferir, "Externa (mesmos dígitos)" if mesmos_digitos[posicao] else "Externa"
                         )
+                        alteradas.append(doadoras[posicao])
 
-                        # Saldos já atualizados dentro de registrar_transferencia()
-                        necessidade_restante -= valor_transferir
+                    if alteradas:
+                        self.reposicionar_doadoras(ug_doadora_info['doadoras_ug'], alteradas)
 
-                nat_deficit['necessidade_total'] = max(0, necessidade_restante)
+                necessidades[nat_deficit['indice']] = max(0, necessidade_restante)
 
                 if necessidade_restante > 0.01:
                     self.log(f"         ⚠️ ATENÇÃO: UG {ug_deficit_info['ug']['codigo']} - {nat_deficit['codigo']} ainda falta {necessidade_restante:,.2f}")
 
-    def registrar_transferencia(self, ug_origem, nat_origem, ug_destino, nat_destino, valor, tipo):
-        # VALIDAÇÃO CRÍTICA: Origem deve ser originalmente positiva, Destino deve ser originalmente negativa
-        if nat_origem['saldo_original'] <= 0:
-            self.log(f"         ❌ ERRO: Tentativa de usar natureza originalmente negativa como doadora: {nat_origem['codigo']} (saldo original: {nat_origem['saldo_original']:,.2f})")
-            return
-
-        if nat_destino['saldo_original'] >= 0:
-            self.log(f"         ❌ ERRO: Tentativa de enviar para natureza originalmente positiva: {nat_destino['codigo']} (saldo original: {nat_destino['saldo_original']:,.2f})")
-            return
+    def ordenar_por_saldo(self, indices) -> np.ndarray:
+        # Maior saldo atual primeiro (ordenação estável: empates mantêm a ordem da planilha)
+        return indices[np.argsort(-self._colunas['saldo_atual'][indices], kind='stable')]
+
+    def agrupar_doadoras(self, indices) -> Dict[str, Any]:
+        # Doadoras por maior saldo + divisão prioritárias/secundárias por dígitos, montada sob demanda
+        ordem = self.ordenar_por_saldo(indices)
+        return {'ordem': ordem, 'digitos': self._colunas['digitos2'][ordem], 'grupos': {}}
+
+    def reposicionar_doadoras(self, doadoras_ug, alteradas):
+        # Só as doadoras que doaram mudam de saldo: as demais continuam ordenadas e as
+        # alteradas são intercaladas de volta (heapq.merge), sem reordenar todas as doadoras
+        saldo_atual = self._colunas['saldo_atual']
+
+        def chave(i):
+            # Maior saldo primeiro; empates pela ordem da planilha (mesma ordem do argsort estável)
+            return (-saldo_atual[i], i)
+
+        alteradas = set(int(i) for i in alteradas)
+        mantidas = [i for i in doadoras_ug['ordem'].tolist() if i not in alteradas]
+        ordem = np.fromiter(heapq.merge(mantidas, sorted(alteradas, key=chave), key=chave),
+                            dtype=doadoras_ug['ordem'].dtype, count=len(doadoras_ug['ordem']))
+
+        doadoras_ug['ordem'] = ordem
+        doadoras_ug['digitos'] = self._colunas['digitos2'][ordem]
+        doadoras_ug['grupos'] = {}
+
+    def separar_prioritarias(self, doadoras_ug, digitos) -> Tuple[np.ndarray, np.ndarray]:
+        # Prioritárias (mesmos 2 primeiros dígitos) antes das secundárias, preservando a ordem por saldo
+        # Déficits com os mesmos dígitos reaproveitam a divisão enquanto a ordem não muda
+        digitos = int(digitos)
+        grupos = doadoras_ug['grupos']
+
+        if digitos not in grupos:
+            ordem = doadoras_ug['ordem']
+            mesmos_digitos = doadoras_ug['digitos'] == digitos
+            doadoras = np.concatenate([ordem[mesmos_digitos], ordem[~mesmos_digitos]])
+            grupos[digitos] = (doadoras, np.arange(len(doadoras)) < np.count_nonzero(mesmos_digitos))
+
+        return grupos[digitos]
+
+    def validar_transferencia(self, nat_origem, nat_destino, valor) -> bool:
+        # Checagens em ordem de probabilidade de falha: limites de saldo (dependem do valor
+        # pedido) antes das regras fixas da natureza, que os chamadores já filtram
+        origem = nat_origem['indice']
+        destino = nat_destino['indice']
+        colunas = self._colunas
+        saldo_atual = colunas['saldo_atual'][origem]
 
         # VALIDAÇÃO CRÍTICA: Não permitir doar mais do que o saldo atual disponível
-        if valor > nat_origem['saldo_atual']:
-            self.log(f"         ❌ ERRO: Tentativa de doar {valor:,.2f} mas origem só tem {nat_origem['saldo_atual']:,.2f} disponível")
-            return
+        if valor > saldo_atual:
+            self.log(f"         ❌ ERRO: Tentativa de doar {valor:,.2f} mas origem só tem {saldo_atual:,.2f} disponível")
+            return False
 
         # VALIDAÇÃO CRÍTICA: Garantir que após a doação, o saldo não fica abaixo do mínimo de segurança
-        saldo_minimo = nat_origem['saldo_original'] * self.PERCENTUAL_RESERVA_MINIMA
-        saldo_apos_doacao = nat_origem['saldo_atual'] - valor
+        saldo_minimo = colunas['saldo_minimo'][origem]
+        saldo_apos_doacao = saldo_atual - valor
 
         if saldo_apos_doacao < saldo_minimo:
             self.log(f"         ❌ ERRO: Doação de {valor:,.2f} violaria saldo mínimo de segurança ({saldo_minimo:,.2f}). Saldo ficaria: {saldo_apos_doacao:,.2f}")
-            return
+            return False
 
         # VALIDAÇÃO CRÍTICA: Naturezas proibidas não podem doar nem receber
-        if self.natureza_eh_proibida(nat_origem['codigo']):
+        if colunas['proibida'][origem]:
             self.log(f"         ❌ ERRO: Natureza origem {nat_origem['codigo']} está na lista de naturezas proibidas (responsabilidade da UG)")
-            return
+            return False
 
-        if self.natureza_eh_proibida(nat_destino['codigo']):
+        if colunas['proibida'][destino]:
             self.log(f"         ❌ ERRO: Natureza destino {nat_destino['codigo']} está na lista de naturezas proibidas (responsabilidade da UG)")
+            return False
+
+        # VALIDAÇÃO CRÍTICA: Origem deve ser originalmente positiva, Destino deve ser originalmente negativa
+        saldo_original = colunas['saldo_original']
+        if saldo_original[origem] <= 0:
+            self.log(f"         ❌ ERRO: Tentativa de usar natureza originalmente negativa como doadora: {nat_origem['codigo']} (saldo original: {saldo_original[origem]:,.2f})")
+            return False
+
+        if saldo_original[destino] >= 0:
+            self.log(f"         ❌ ERRO: Tentativa de enviar para natureza originalmente positiva: {nat_destino['codigo']} (saldo original: {saldo_original[destino]:,.2f})")
+            return False
+
+        return True
+
+    def registrar_transferencia(self, ug_origem, nat_origem, ug_destino, nat_destino, valor, tipo):
+        if not self.validar_transferencia(nat_origem, nat_destino, valor):
             return
 
+        # Saldos lidos das colunas; os dicts das naturezas ficam só para nomes/códigos e relatórios
+        origem = nat_origem['indice']
+        destino = nat_destino['indice']
+        saldo_atual = self._colunas['saldo_atual']
+
         # Log detalhado ANTES da transferência
-        self.log(f"         >> ANTES: Origem {nat_origem['codigo']} saldo={nat_origem['saldo_atual']:,.2f} | Destino {nat_destino['codigo']} saldo={nat_destino['saldo_atual']:,.2f}")
+        self.log_detalhe("         >> ANTES: Origem {} saldo={:,.2f} | Destino {} saldo={:,.2f}", nat_origem['codigo'], saldo_atual[origem], nat_destino['codigo'], saldo_atual[destino])
 
         # Garantir que sempre temos a fonte (buscar da natureza ou da UG se necessário)
         fonte = nat_origem.get('fonte')
-        if fonte is None:
+        if fonte is None and ug_origem in self._ugs_por_codigo:
             # Buscar da UG origem
-            for ug in self.ugs_dados:
-                if ug['codigo'] == ug_origem:
-                    fonte = ug.get('fonte')
-                    break
+            fonte = self._ugs_por_codigo[ug_origem].get('fonte')
 
         if fonte is None:
             self.log(f"         ⚠️ AVISO: Fonte não encontrada para UG {ug_origem} — remanejamento registrado sem fonte")
 
-        self.remanejamentos.append({
-            'Tipo': tipo,
-            'Fonte': int(fonte) if fonte is not None else None,
-            'UG Origem': ug_origem,
-            'Natureza Origem': nat_origem['codigo'],
-            'Nome Natureza Origem': nat_origem['nome'],
-            'UG Destino': ug_destino,
-            'Natureza Destino': nat_destino['codigo'],
-            'Nome Natureza Destino': nat_destino['nome'],
-            'Valor': round(valor, 2),
-            'ug_origem': ug_origem,
-            'ug_destino': ug_destino
-        })
+        fonte = int(fonte) if fonte is not None else None
+        self._chaves_remanejamento.add((fonte, ug_origem, nat_origem['codigo'], ug_destino, nat_destino['codigo']))
+
+        remanejamentos = self.remanejamentos
+        remanejamentos['Tipo'].append(tipo)
+        remanejamentos['Fonte'].append(fonte)
+        remanejamentos['UG Origem'].append(ug_origem)
+        remanejamentos['Natureza Origem'].append(nat_origem['codigo'])
+        remanejamentos['Nome Natureza Origem'].append(nat_origem['nome'])
+        remanejamentos['UG Destino'].append(ug_destino)
+        remanejamentos['Natureza Destino'].append(nat_destino['codigo'])
+        remanejamentos['Nome Natureza Destino'].append(nat_destino['nome'])
+        remanejamentos['Valor'].append(round(valor * 100))
+        remanejamentos['ug_origem'].append(ug_origem)
+        remanejamentos['ug_destino'].append(ug_destino)
+
+        if ug_origem == ug_destino:
+            self.total_internos += 1
+        else:
+            self.total_externos += 1
 
-        self.log(f"         ✓ {tipo}: {nat_origem['codigo']} (Fonte {nat_origem['fonte']}) → {nat_destino['codigo']}: {valor:,.2f}")
+        self.log_detalhe("         ✓ {}: {} (Fonte {}) → {}: {:,.2f}", tipo, nat_origem['codigo'], nat_origem['fonte'], nat_destino['codigo'], valor)
 
         # IMPORTANTE: Atualizar os saldos DENTRO desta função
-        nat_origem['saldo_atual'] -= valor
-        nat_destino['saldo_atual'] += valor
+        # (coluna usada nos cálculos e dict usado nos relatórios)
+        saldo_atual[origem] -= valor
+        saldo_atual[destino] += valor
+        nat_origem['saldo_atual'] = float(saldo_atual[origem])
+        nat_destino['saldo_atual'] = float(saldo_atual[destino])
+        self.ugs_dados[self._colunas['ug_id'][origem]]['saldo_total_ajustado'] -= valor
+        self.ugs_dados[self._colunas['ug_id'][destino]]['saldo_total_ajustado'] += valor
 
         # Log detalhado DEPOIS da transferência
-        self.log(f"         << DEPOIS: Origem {nat_origem['codigo']} saldo={nat_origem['saldo_atual']:,.2f} | Destino {nat_destino['codigo']} saldo={nat_destino['saldo_atual']:,.2f}")
+        self.log_detalhe("         << DEPOIS: Origem {} saldo={:,.2f} | Destino {} saldo={:,.2f}", nat_origem['codigo'], saldo_atual[origem], nat_destino['codigo'], saldo_atual[destino])
 
     def validar_resultado(self) -> Dict[str, bool]:
-        tem_negativo = False
-
         self.log("\n   === RESUMO FINAL DE TODAS AS NATUREZAS ===")
 
-        for ug in self.ugs_dados:
-            for nat in ug['naturezas']:
-                saldo_original = nat['saldo_original']
-                saldo_atual = nat['saldo_atual']
-                diferenca = saldo_atual - saldo_original
-
-                # Mostrar TODAS as naturezas que mudaram
-                if abs(diferenca) > 0.01:
-                    if saldo_original < 0:  # Era deficitária
-                        self.log(f"   {ug['codigo']} - {nat['codigo']} (DEFICITÁRIA): {saldo_original:,.2f} → {saldo_atual:,.2f} (recebeu {diferenca:,.2f})")
-
-                        if saldo_atual < -0.01:
-                            tem_negativo = True
-                            self.log(f"      ❌ AINDA NEGATIVO!")
-                        elif abs(saldo_atual) < 0.01:
-                            self.log(f"      ✓ Zerado com sucesso")
-                        else:
-                            self.log(f"      ⚠️ Parcialmente coberto")
-
-                    elif saldo_original > 0:  # Era superavitária
-                        if diferenca > 0:
-                            self.log(f"   {ug['codigo']} - {nat['codigo']} (SUPERAVITÁRIA): {saldo_original:,.2f} → {saldo_atual:,.2f} (AUMENTOU {diferenca:,.2f}) ⚠️ ERRO!")
-                        else:
-                            saldo_minimo = saldo_original * self.PERCENTUAL_RESERVA_MINIMA
-                            percentual_preservado = (saldo_atual / saldo_original) * 100
-                            self.log(f"   {ug['codigo']} - {nat['codigo']} (DOADORA): {saldo_original:,.2f} → {saldo_atual:,.2f} (doou {abs(diferenca):,.2f}, preservou {percentual_preservado:.1f}%)")
-
-                            if saldo_atual < saldo_minimo:
-                                self.log(f"      ⚠️ ATENÇÃO: Saldo abaixo do mínimo de segurança ({saldo_minimo:,.2f})")
+        # Classificação de todas as naturezas de uma vez, sobre as colunas
+        colunas = self._colunas
+        saldos_originais = colunas['saldo_original']
+        saldos_atuais = colunas['saldo_atual']
+        diferencas = saldos_atuais - saldos_originais
+        saldos_minimos = colunas['saldo_minimo']
+
+        # Mostrar TODAS as naturezas que mudaram
+        mudou = np.abs(diferencas) > 0.01
+        ainda_negativa = mudou & (saldos_originais < 0) & (saldos_atuais < -0.01)
+        superavitaria = mudou & (saldos_originais > 0)
+        aumentou = superavitaria & (diferencas > 0)
+        abaixo_minimo = superavitaria & ~aumentou & (saldos_atuais < saldos_minimos)
+
+        tem_negativo = bool(ainda_negativa.any())
+
+        # Só as naturezas com problema são percorridas, a menos que o log seja detalhado
+        exibir = mudou if self.LOG_DETALHADO else (ainda_negativa | aumentou | abaixo_minimo)
+
+        # Métodos e colunas usados no laço ficam em variáveis locais
+        log = self.log
+        log_detalhe = self.log_detalhe
+        ugs_dados = self.ugs_dados
+        naturezas = self._naturezas
+        ug_ids = colunas['ug_id']
+
+        for i in np.flatnonzero(exibir).tolist():
+            ug_codigo = ugs_dados[ug_ids[i]]['codigo']
+            nat_codigo = naturezas[i]['codigo']
+            saldo_original = float(saldos_originais[i])
+            saldo_atual = float(saldos_atuais[i])
+            diferenca = float(diferencas[i])
+
+            # (naturezas com problema sempre entram no log; as demais só no log detalhado)
+            if saldo_original < 0:  # Era deficitária
+                negativa = ainda_negativa[i]
+                registrar = log if negativa else log_detalhe
+                registrar("   {} - {} (DEFICITÁRIA): {:,.2f} → {:,.2f} (recebeu {:,.2f})", ug_codigo, nat_codigo, saldo_original, saldo_atual, diferenca)
+
+                if negativa:
+                    log(f"      ❌ AINDA NEGATIVO!")
+                elif abs(saldo_atual) < 0.01:
+                    log_detalhe(f"      ✓ Zerado com sucesso")
+                else:
+                    log_detalhe(f"      ⚠️ Parcialmente coberto")
+
+            elif saldo_original > 0:  # Era superavitária
+                if aumentou[i]:
+                    log(f"   {ug_codigo} - {nat_codigo} (SUPERAVITÁRIA): {saldo_original:,.2f} → {saldo_atual:,.2f} (AUMENTOU {diferenca:,.2f}) ⚠️ ERRO!")
+                else:
+                    abaixo = abaixo_minimo[i]
+                    registrar = log if abaixo else log_detalhe
+                    registrar("   {} - {} (DOADORA): {:,.2f} → {:,.2f} (doou {:,.2f}, preservou {:.1f}%)", ug_codigo, nat_codigo, saldo_original, saldo_atual, abs(diferenca), (saldo_atual / saldo_original) * 100)
+
+                    if abaixo:
+                        log(f"      ⚠️ ATENÇÃO: Saldo abaixo do mínimo de segurança ({float(saldos_minimos[i]):,.2f})")
 
         if not tem_negativo:
             self.log("\n   ✓ Nenhum saldo negativo")
         else:
             self.log("\n   ❌ AINDA EXISTEM SALDOS NEGATIVOS!")
 
-        if len(self.remanejamentos) > 0:
-            self.log(f"   ✓ {len(self.remanejamentos)} remanejamentos realizados")
+        total_remanejamentos = len(self.remanejamentos['Valor'])
+        if total_remanejamentos > 0:
+            self.log(f"   ✓ {total_remanejamentos} remanejamentos realizados")
 
         return {
             'nenhum_saldo_negativo': not tem_negativo,
-            'somas_conferem': len(self.remanejamentos) > 0
+            'somas_conferem': total_remanejamentos > 0
         }
 
     def gerar_excel(self) -> bytes:
         output = io.BytesIO()
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Aba 1: Saldos
-            df_aba1 = self.gerar_aba_saldos()
-            df_aba1.to_excel(writer, sheet_name='Saldos Ajustados', index=False)
+        # constant_memory: cada linha é gravada no arquivo assim que concluída,
+        # sem manter todas as células da planilha em memória
+        # strings_to_formulas/strings_to_urls=False: textos são sempre gravados como texto
+        # (sem detecção de fórmulas ou hyperlinks, como na gravação via pandas/openpyxl)
+        # nan_inf_to_errors: um saldo NaN vira erro na célula em vez de interromper a geração
+        workbook = xlsxwriter.Workbook(output, {
+            'constant_memory': True,
+            'use_zip64': True,
+            'strings_to_formulas': False,
+            'strings_to_urls': False,
+            'nan_inf_to_errors': True
+        })
+        formatos = {
+            'cabecalho': workbook.add_format({
+                'bold': True,
+                'font_color': '#FFFFFF',
+                'bg_color': '#366092',
+                'align': 'center',
+                'valign': 'vcenter',
+                'border': 1
+            }),
+            'celula': workbook.add_format({'border': 1})
+        }
 
-            # Aba 2: Remanejamentos
-            df_aba2 = self.gerar_aba_remanejamento()
-            df_aba2.to_excel(writer, sheet_name='Remanejamentos', index=False)
+        # As abas são gravadas direto das listas de colunas, sem DataFrame intermediário
+        # Aba 1: Saldos
+        self.escrever_aba(workbook, 'Saldos Ajustados', self.gerar_aba_saldos(), formatos)
 
-            workbook = writer.book
-            self.formatar_planilha(workbook['Saldos Ajustados'])
-            self.formatar_planilha(workbook['Remanejamentos'])
+        # Aba 2: Remanejamentos
+        self.escrever_aba(workbook, 'Remanejamentos', self.gerar_aba_remanejamento(), formatos)
+
+        workbook.close()
 
-        output.seek(0)
         self.log("   Excel gerado com sucesso")
         return output.getvalue()
 
-    def gerar_aba_saldos(self) -> pd.DataFrame:
-        dados = []
+    def gerar_aba_saldos(self) -> Dict[str, list]:
+        # Uma lista por coluna (em vez de um dict por linha), gravada direto no Excel
+        colunas = {
+            'Fonte': [],
+            'UG': [],
+            'Nome UG': [],
+            'Tipo': [],
+            'Natureza': [],
+            'Nome Natureza': [],
+            'Saldo Original': [],
+            'Saldo Ajustado': []
+        }
+        fontes, ugs, nomes_ug, tipos, naturezas, nomes_natureza, saldos_originais, saldos_ajustados = colunas.values()
 
         for ug in self.ugs_dados:
-            saldo_total_ajustado = sum(nat['saldo_atual'] for nat in ug['naturezas'])
-
-            dados.append({
-                'Fonte': ug['fonte'],
-                'UG': ug['codigo'],
-                'Nome UG': ug['nome'],
-                'Tipo': 'TOTAL',
-                'Natureza': '',
-                'Nome Natureza': '',
-                'Saldo Original': ug['saldo_total'],
-                'Saldo Ajustado': round(saldo_total_ajustado, 2)
-            })
+            fontes.append(ug['fonte'])
+            ugs.append(ug['codigo'])
+            nomes_ug.append(ug['nome'])
+            tipos.append('TOTAL')
+            naturezas.append('')
+            nomes_natureza.append('')
+            saldos_originais.append(ug['saldo_total'])
+            saldos_ajustados.append(round(ug['saldo_total_ajustado'], 2))
 
             for nat in ug['naturezas']:
-                dados.append({
-                    'Fonte': nat['fonte'],
-                    'UG': '',
-                    'Nome UG': '',
-                    'Tipo': 'Natureza',
-                    'Natureza': nat['codigo'],
-                    'Nome Natureza': nat['nome'],
-                    'Saldo Original': round(nat['saldo_original'], 2),
-                    'Saldo Ajustado': round(nat['saldo_atual'], 2)
-                })
-
-        return pd.DataFrame(dados)
-
-    def gerar_aba_remanejamento(self) -> pd.DataFrame:
-        if not self.remanejamentos:
-            return pd.DataFrame({
+                fontes.append(nat['fonte'])
+                ugs.append('')
+                nomes_ug.append('')
+                tipos.append('Natureza')
+                naturezas.append(nat['codigo'])
+                nomes_natureza.append(nat['nome'])
+                saldos_originais.append(round(nat['saldo_original'], 2))
+                saldos_ajustados.append(round(nat['saldo_atual'], 2))
+
+        return colunas
+
+    def gerar_aba_remanejamento(self) -> Dict[str, list]:
+        total_remanejamentos = len(self.remanejamentos['Valor'])
+        if not total_remanejamentos:
+            return {
                 'Tipo': [],
                 'Fonte': [],
                 'UG Origem': [],
@@ -806,82 +1028,72 @@ class ProcessadorOrcamento:
                 'UG Destino': [],
                 'Natureza Destino': [],
                 'Valor': []
-            })
+            }
 
         self.log(f"\n   === CONSOLIDANDO REMANEJAMENTOS ===")
-        self.log(f"   Total antes da consolidação: {len(self.remanejamentos)}")
-
-        # Consolidar transferências idênticas (mesma origem → mesmo destino)
-        consolidados = {}
-        for rem in self.remanejamentos:
-            # Chave única: Fonte + UG Origem + Natureza Origem + UG Destino + Natureza Destino
-            chave = (
-                rem['Fonte'],
-                rem['UG Origem'],
-                rem['Natureza Origem'],
-                rem['UG Destino'],
-                rem['Natureza Destino']
-            )
-
-            if chave in consolidados:
-                # Somar valores
-                consolidados[chave]['Valor'] += rem['Valor']
-            else:
-                # Primeira ocorrência, adicionar
-                consolidados[chave] = {
-                    'Tipo': rem['Tipo'],
-                    'Fonte': rem['Fonte'],
-                    'UG Origem': rem['UG Origem'],
-                    'Natureza Origem': rem['Natureza Origem'],
-                    'Nome Natureza Origem': rem['Nome Natureza Origem'],
-                    'UG Destino': rem['UG Destino'],
-                    'Natureza Destino': rem['Natureza Destino'],
-                    'Nome Natureza Destino': rem['Nome Natureza Destino'],
-                    'Valor': rem['Valor']
-                }
+        self.log(f"   Total antes da consolidação: {total_remanejamentos}")
+
+        colunas = ['Tipo', 'Fonte', 'UG Origem', 'Natureza Origem', 'Nome Natureza Origem',
+                   'UG Destino', 'Natureza Destino', 'Nome Natureza Destino', 'Valor']
+
+        # Sem pares repetidos não há o que consolidar
+        if len(self._chaves_remanejamento) == total_remanejamentos:
+            self.log(f"   Total após consolidação: {total_remanejamentos}")
+            remanejamentos = self.remanejamentos_em_reais()
+            return {coluna: remanejamentos[coluna] for coluna in colunas}
+
+        # Consolidar transferências idênticas (mesma origem → mesmo destino) com groupby:
+        # chave única = Fonte + UG Origem + Natureza Origem + UG Destino + Natureza Destino,
+        # grupos na ordem da primeira ocorrência (sort=False) e Fonte vazia como chave válida (dropna=False)
+        # Textos repetidos (tipos, UGs, naturezas e seus nomes) como category: o groupby compara
+        # códigos inteiros em vez de strings; observed=True agrupa só as combinações existentes
+        chave = ['Fonte', 'UG Origem', 'Natureza Origem', 'UG Destino', 'Natureza Destino']
+        df = pd.DataFrame(self.remanejamentos, copy=False).astype({
+            'Tipo': 'category',
+            'UG Origem': 'category',
+            'Natureza Origem': 'category',
+            'Nome Natureza Origem': 'category',
+            'UG Destino': 'category',
+            'Natureza Destino': 'category',
+            'Nome Natureza Destino': 'category'
+        })
+        df = df.groupby(chave, sort=False, observed=True, as_index=False, dropna=False).agg({
+            'Tipo': 'first',
+            'Nome Natureza Origem': 'first',
+            'Nome Natureza Destino': 'first',
+            'Valor': 'sum'
+        })
 
-        # Converter de volta para lista
-        remanejamentos_consolidados = list(consolidados.values())
+        df['Valor'] = df['Valor'] / 100
 
-        self.log(f"   Total após consolidação: {len(remanejamentos_consolidados)}")
-        reducao = len(self.remanejamentos) - len(remanejamentos_consolidados)
+        self.log(f"   Total após consolidação: {len(df)}")
+        reducao = total_remanejamentos - len(df)
         if reducao > 0:
-            percentual = (reducao / len(self.remanejamentos)) * 100
+            percentual = (reducao / total_remanejamentos) * 100
             self.log(f"   ✓ Redução: {reducao} remanejamentos ({percentual:.1f}%)")
 
-        df = pd.DataFrame(remanejamentos_consolidados)
-        colunas = ['Tipo', 'Fonte', 'UG Origem', 'Natureza Origem', 'Nome Natureza Origem',
-                   'UG Destino', 'Natureza Destino', 'Nome Natureza Destino', 'Valor']
-        return df[colunas]
-
-    def formatar_planilha(self, worksheet):
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 60)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
+        # Fonte vazia (NaN no groupby) volta a ser None, gravado como célula em branco
+        df = df[colunas].astype(object)
+        return df.where(df.notna(), None).to_dict('list')
+
+    def remanejamentos_em_reais(self) -> Dict[str, list]:
+        # Mesmas colunas de self.remanejamentos, com o valor convertido de centavos para reais
+        reais = [centavos / 100 for centavos in self.remanejamentos['Valor']]
+        return {coluna: reais if coluna == 'Valor' else valores for coluna, valores in self.remanejamentos.items()}
+
+    def escrever_aba(self, workbook, nome_aba: str, colunas: Dict[str, list], formatos: Dict):
+        # Em constant_memory as linhas precisam ser escritas em ordem, de cima para baixo
+        worksheet = workbook.add_worksheet(nome_aba)
+
+        worksheet.write_row(0, 0, list(colunas), formatos['cabecalho'])
+
+        # None é gravado pelo write_row como célula em branco formatada
+        for linha_idx, linha in enumerate(zip(*colunas.values()), start=1):
+            worksheet.write_row(linha_idx, 0, linha, formatos['celula'])
 
-        for row in worksheet.iter_rows():
-            for cell in row:
-                cell.border = thin_border
+        # Largura de cada coluna: maior texto entre o cabeçalho e os valores preenchidos,
+        # medido coluna a coluna pelo pandas em vez de célula a célula
+        for col_idx, (coluna, valores) in enumerate(colunas.items()):
+            comprimentos = pd.Series(valores, dtype=object).dropna().astype(str).str.len()
+            largura = max(len(str(coluna)), int(comprimentos.max()) if len(comprimentos) else 0)
+            worksheet.set_column(col_idx, col_idx, min(largura + 2, 60))